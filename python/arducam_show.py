@@ -1,13 +1,15 @@
+import os
+from typing import Tuple
+from concurrent.futures import ThreadPoolExecutor
 from pathlib import Path
 from argparse import ArgumentParser, Namespace
 
-import numpy
 from numba import cuda
 import numba
-import cv2 as cv
 import numpy as np
 from src.utils import (
     read_arducam_image,
+    read_raw_into,
     ImageDisplay
 )
 
@@ -18,194 +20,221 @@ resolution_map = {
     "HIGH": {"width": 4056, "height": 3040, "band_width": int(4056 / 2), "band_height": int(3040 / 2), "framerate": 15}
 }
 
-@cuda.jit
-def blue_demosaicing(image, out_image, image_data):
+# Threads per block of the demosaicing kernels, which read several neighbours per pixel and use more registers than
+# an elementwise kernel
+TPB_DEMOSAIC = 256
+
+# 2x2 response of the white calibration around the centre of a band, packed in 4 bits, and the band type it selects
+INTERPOLATION_TYPES = {
+    0b0001: 0,  # Great response in the red filter
+    0b0110: 1,  # Great response in the green filter
+    0b1000: 2,  # Great response in the blue filter
+    0b1111: 3,  # Great response in all filters
+}
+
+@cuda.jit(device=True)
+def pixel_reflectance(image, scale, offset, pos):
     """
-    image_data:
-        0: start position of the image
-        1: size of the image
-        2: total number of rows
-        3: total number of columns
+    (image - black * 0.8) / (white - black * 0.8) clamped to [0, 1], expressed as a single multiply-add with the
+    scale and offset precomputed by reflectance_coefficients
     """
-    tx = cuda.threadIdx.x
-    bx = cuda.blockIdx.x
-    bd = cuda.blockDim.x
-    pos = bx * bd + tx
-    if pos < image_data[1]:
-        row_and_col_index = numba.float32(pos) / image_data[3]
-        row = numba.uint32(row_and_col_index)
-        col_index = numba.uint32(pos - row*image_data[3])
-        row_odd_or_even = row % 2
-        col_odd_or_even = col_index % 2
-        if row_odd_or_even == 0:
-            # A real blue value, copied directly to the output image
+    value = image[pos] * scale[pos] + offset[pos]
+    return min(max(value, numba.float32(0)), numba.float32(1))
+
+
+@cuda.jit(device=True)
+def to_12_bits(value):
+    """Scale a corrected reflectance to the 12-bit range of the raw images, saturating at 4095 so values above 1 (e.g.
+    with a NIR gain) do not wrap when the 12 bits are masked"""
+    return numba.uint16(min(value * 4095, 4095))
+
+
+@cuda.jit(device=True)
+def blue_demosaicing(image, scale, offset, pos, row, col_index, rows, cols):
+    row_odd_or_even = row % 2
+    col_odd_or_even = col_index % 2
+    if row_odd_or_even == 0:
+        # A real blue value, copied directly to the output image
+        if col_odd_or_even == 0:
+            return pixel_reflectance(image, scale, offset, pos)
+        else:
+            # Can't do an interpolation with the last value. The previous blue is assigned
+            if col_index == (cols - 1):
+                return pixel_reflectance(image, scale, offset, pos - 1)
+            # In the first row, an interpolation between the previous blue value and the next is made
+            else:
+                return (pixel_reflectance(image, scale, offset, pos - 1)
+                        + pixel_reflectance(image, scale, offset, pos + 1)) / 2
+    else:
+        # On the last row
+        if row == rows - 1:
             if col_odd_or_even == 0:
-                out_image[image_data[0] + pos] = image[image_data[0]+pos]
+                # If it is even, the previous blue is copied
+                return pixel_reflectance(image, scale, offset, pos - cols)
             else:
-                # Can't do an interpolation with the last value. The previous blue is assigned
-                if col_index == (image_data[3] - 1):
-                    out_image[image_data[0] + pos] = image[image_data[0] + pos - 1]
-                # In the first row, an interpolation between the previous blue value and the next is made
-                else:
-                    new_blue = (image[image_data[0] + pos - 1] + image[image_data[0] + pos + 1]) / 2
-                    out_image[image_data[0] + pos] = new_blue
-        else:
-            # On the last row
-            if row == image_data[2] - 1:
-                if col_odd_or_even == 0:
-                    # If it is even, the previous blue is copied
-                    out_image[image_data[0] + pos] = image[image_data[0] + pos - image_data[3]]
+                if col_index == (cols - 1):
+                    return pixel_reflectance(image, scale, offset, pos - cols - 1)
+                # Otherwise, the two superior columns are interpolated
                 else:
-                    if col_index == (image_data[3] - 1):
-                        out_image[image_data[0] + pos] = image[image_data[0] + pos - image_data[3] - 1]
-                    # Otherwise, the two superior columns are interpolated
-                    else:
-                        new_blue = (image[image_data[0] + pos - image_data[3] - 1]
-                                    + image[image_data[0] + pos - image_data[3] + 1]) / 2
-                        out_image[image_data[0] + pos] = new_blue
+                    return (pixel_reflectance(image, scale, offset, pos - cols - 1)
+                            + pixel_reflectance(image, scale, offset, pos - cols + 1)) / 2
 
+        else:
+            if col_odd_or_even == 0:
+                # If the column is even, an interpolation between the superior and inferior blue is made
+                return (pixel_reflectance(image, scale, offset, pos - cols)
+                        + pixel_reflectance(image, scale, offset, pos + cols)) / 2
             else:
-                if col_odd_or_even == 0:
-                    # If the column is even, an interpolation between the superior and inferior blue is made
-                    new_blue = (image[image_data[0] + pos - image_data[3]] + image[image_data[0] + pos + image_data[3]]) / 2
-                    out_image[image_data[0] + pos] = new_blue
+                if col_index == (cols - 1):
+                    # If is the last column, the interpolation is only between the two previous corners
+                    return (pixel_reflectance(image, scale, offset, pos - cols - 1)
+                            + pixel_reflectance(image, scale, offset, pos + cols - 1)) / 2
                 else:
-                    if col_index == (image_data[3] - 1):
-                        # If is the last column, the interpolation is only between the two previous corners
-                        new_blue = (image[image_data[0] + pos - image_data[3] - 1]
-                                    + image[image_data[0] + pos + image_data[3] - 1]) / 2
-                        out_image[image_data[0] + pos] = new_blue
-                    else:
-                        # If is odd, an interpolation between the four blues around the position is made
-                        new_blue = (image[image_data[0] + pos - image_data[3] - 1]
-                                    + image[image_data[0] + pos - image_data[3] + 1]
-                                    + image[image_data[0] + pos + image_data[3] - 1]
-                                    + image[image_data[0] + pos + image_data[3] + 1]) / 4
-                        out_image[image_data[0] + pos] = new_blue
-
-
-@cuda.jit
-def red_demosaicing(image, out_image, image_data):
-    """
-    image_data:
-        0: start position of the image
-        1: size of the image
-        2: total number of rows
-        3: total number of columns
-    """
-    tx = cuda.threadIdx.x
-    bx = cuda.blockIdx.x
-    bd = cuda.blockDim.x
-    pos = bx * bd + tx
-    if pos < image_data[1]:
-        row_and_col_index = numba.float32(pos) / image_data[3]
-        row = numba.uint32(row_and_col_index)
-        col_index = numba.uint32(pos - row*image_data[3])
-        row_odd_or_even = row % 2
-        col_odd_or_even = col_index % 2
-        if row_odd_or_even == 0:
-            # On the first row
-            if row == 0:
-                if col_odd_or_even == 0:
-                    if col_index == 0:
-                        out_image[image_data[0] + pos] = image[image_data[0] + pos + image_data[3] + 1]
-                    # Otherwise, the two inferior columns are interpolated
-                    else:
-                        new_red = (image[image_data[0] + pos + image_data[3] - 1]
-                                    + image[image_data[0] + pos + image_data[3] + 1]) / 2
-                        out_image[image_data[0] + pos] = new_red
+                    # If is odd, an interpolation between the four blues around the position is made
+                    return (pixel_reflectance(image, scale, offset, pos - cols - 1)
+                            + pixel_reflectance(image, scale, offset, pos - cols + 1)
+                            + pixel_reflectance(image, scale, offset, pos + cols - 1)
+                            + pixel_reflectance(image, scale, offset, pos + cols + 1)) / 4
+
+
+@cuda.jit(device=True)
+def red_demosaicing(image, scale, offset, pos, row, col_index, rows, cols):
+    row_odd_or_even = row % 2
+    col_odd_or_even = col_index % 2
+    if row_odd_or_even == 0:
+        # On the first row
+        if row == 0:
+            if col_odd_or_even == 0:
+                if col_index == 0:
+                    return pixel_reflectance(image, scale, offset, pos + cols + 1)
+                # Otherwise, the two inferior columns are interpolated
                 else:
-                    # If it is odd, the red below is copied
-                    out_image[image_data[0] + pos] = image[image_data[0] + pos + image_data[3]]
-                    
+                    return (pixel_reflectance(image, scale, offset, pos + cols - 1)
+                            + pixel_reflectance(image, scale, offset, pos + cols + 1)) / 2
             else:
-                if col_odd_or_even == 0:
-                    if col_index == 0:
-                        # If is the first column, the interpolation is only between the two next corners
-                        new_red = (image[image_data[0] + pos - image_data[3] + 1]
-                                    + image[image_data[0] + pos + image_data[3] + 1]) / 2
-                        out_image[image_data[0] + pos] = new_red
-                    else:
-                        # If is even, an interpolation between the four reds around the position is made
-                        new_red = (image[image_data[0] + pos - image_data[3] - 1]
-                                    + image[image_data[0] + pos - image_data[3] + 1]
-                                    + image[image_data[0] + pos + image_data[3] - 1]
-                                    + image[image_data[0] + pos + image_data[3] + 1]) / 4
-                        out_image[image_data[0] + pos] = new_red
-                    
-                else:
-                    # If the column is odd, an interpolation between the superior and inferior red is made
-                    new_red = (image[image_data[0] + pos - image_data[3]] + image[
-                        image_data[0] + pos + image_data[3]]) / 2
-                    out_image[image_data[0] + pos] = new_red
+                # If it is odd, the red below is copied
+                return pixel_reflectance(image, scale, offset, pos + cols)
 
         else:
             if col_odd_or_even == 0:
-                # Can't do an interpolation with the first value. The next red is assigned
                 if col_index == 0:
-                    out_image[image_data[0] + pos] = image[image_data[0] + pos + 1]
+                    # If is the first column, the interpolation is only between the two next corners
+                    return (pixel_reflectance(image, scale, offset, pos - cols + 1)
+                            + pixel_reflectance(image, scale, offset, pos + cols + 1)) / 2
                 else:
-                    # An interpolation between the previous red value and the next is made
-                    new_red = (image[image_data[0] + pos - 1] + image[image_data[0] + pos + 1]) / 2
-                    out_image[image_data[0] + pos] = new_red
+                    # If is even, an interpolation between the four reds around the position is made
+                    return (pixel_reflectance(image, scale, offset, pos - cols - 1)
+                            + pixel_reflectance(image, scale, offset, pos - cols + 1)
+                            + pixel_reflectance(image, scale, offset, pos + cols - 1)
+                            + pixel_reflectance(image, scale, offset, pos + cols + 1)) / 4
+
+            else:
+                # If the column is odd, an interpolation between the superior and inferior red is made
+                return (pixel_reflectance(image, scale, offset, pos - cols)
+                        + pixel_reflectance(image, scale, offset, pos + cols)) / 2
+
+    else:
+        if col_odd_or_even == 0:
+            # Can't do an interpolation with the first value. The next red is assigned
+            if col_index == 0:
+                return pixel_reflectance(image, scale, offset, pos + 1)
             else:
-                # A real red value, copied directly to the output image
-                out_image[image_data[0] + pos] = image[image_data[0] + pos]
+                # An interpolation between the previous red value and the next is made
+                return (pixel_reflectance(image, scale, offset, pos - 1)
+                        + pixel_reflectance(image, scale, offset, pos + 1)) / 2
+        else:
+            # A real red value, copied directly to the output image
+            return pixel_reflectance(image, scale, offset, pos)
+
+
+@cuda.jit(device=True)
+def nir_filtering(image, scale, offset, pos, row, col_index, f00, f01, f10, f11):
+    # The 2x2 filter is selected with the lowest bit of the row and the column
+    if row & 1 == 0:
+        gain = f01 if col_index & 1 else f00
+    else:
+        gain = f11 if col_index & 1 else f10
+    return pixel_reflectance(image, scale, offset, pos) * gain
+
 
-@cuda.jit()
-def nir_filtering(image, out_image, image_data, filter):
+@cuda.jit(device=True)
+def interior_interpolation(image, scale, offset, pos, row_odd_or_even, col_odd_or_even, cols):
     """
-        image_data:
-            0: start position of the image
-            1: size of the image
-            2: total number of rows
-            3: total number of columns
-        """
-    tx = cuda.threadIdx.x
-    bx = cuda.blockIdx.x
-    bd = cuda.blockDim.x
-    pos = bx * bd + tx
-    if pos < image_data[1]:
-        row_and_col_index = numba.float32(pos) / image_data[3]
-        row = numba.uint32(row_and_col_index)
-        col_index = numba.uint32(pos - row * image_data[3])
-        row_odd_or_even = row % 2
-        col_odd_or_even = col_index % 2
-        out_image[image_data[0] + pos] = image[image_data[0] + pos] * filter[row_odd_or_even * 2 + col_odd_or_even]
-                        
+    Interpolation of a pixel whose eight neighbours are inside the band, using the parity of its row and column
+    relative to the real samples of the band. No border checks are needed.
+    """
+    if row_odd_or_even == 0:
+        if col_odd_or_even == 0:
+            # A real value, copied directly to the output image
+            return pixel_reflectance(image, scale, offset, pos)
+        # Interpolation between the previous and the next value of the row
+        return (pixel_reflectance(image, scale, offset, pos - 1)
+                + pixel_reflectance(image, scale, offset, pos + 1)) / 2
+    if col_odd_or_even == 0:
+        # Interpolation between the superior and inferior values
+        return (pixel_reflectance(image, scale, offset, pos - cols)
+                + pixel_reflectance(image, scale, offset, pos + cols)) / 2
+    # Interpolation between the four values around the position
+    return (pixel_reflectance(image, scale, offset, pos - cols - 1)
+            + pixel_reflectance(image, scale, offset, pos - cols + 1)
+            + pixel_reflectance(image, scale, offset, pos + cols - 1)
+            + pixel_reflectance(image, scale, offset, pos + cols + 1)) / 4
+
 
 @cuda.jit
-def gpu_reflectance(image, white, black, reflectance):
-    tx = cuda.threadIdx.x
-    bx = cuda.blockIdx.x
-    bd = cuda.blockDim.x
-    pos = bx * bd + tx
-    if pos < image.shape[0]:
-        value = (image[pos] - black[pos] * 0.8) / (white[pos] - black[pos] * 0.8)
-        if value < 0:
-            value = 0
-        elif value > 1:
-            value = 1
-        reflectance[pos] = value
+def band_correction_interior(image, scale, offset, out_image, start, rows, cols, band_type, f00, f01, f10, f11):
+    """
+    Compute the reflectance of the band and apply its interpolation in a single pass, so the reflectance is never
+    written to global memory. Only the pixels away from the borders are processed, the border ones are handled by
+    band_correction_border.
+    start: position of the first pixel of the band in the image
+    rows, cols: size of the band
+    band_type:
+        0: red demosaicing
+        2: blue demosaicing
+        3: NIR filtering
+    f00, f01, f10, f11: 2x2 NIR filter, only used by the NIR bands
+    """
+    # One thread per interior pixel of the band in a 2D grid: x runs along the columns and y along the rows
+    col_index = cuda.blockIdx.x * cuda.blockDim.x + cuda.threadIdx.x + 1
+    row = cuda.blockIdx.y * cuda.blockDim.y + cuda.threadIdx.y + 1
+    if row < rows - 1 and col_index < cols - 1:
+        pos = start + row * cols + col_index
+        if band_type == 0:
+            # Real red values are in the odd rows and columns, the blue layout applies with the parities swapped
+            value = interior_interpolation(image, scale, offset, pos, 1 - row % 2, 1 - col_index % 2, cols)
+        elif band_type == 2:
+            value = interior_interpolation(image, scale, offset, pos, row % 2, col_index % 2, cols)
+        else:
+            value = nir_filtering(image, scale, offset, pos, row, col_index, f00, f01, f10, f11)
+        out_image[pos] = to_12_bits(value)
 
 
 @cuda.jit
-def gpu_reflectance_with_kernel(image, white, black, kernel, reflectance):
+def band_correction_border(image, scale, offset, out_image, start, rows, cols, band_type, f00, f01, f10, f11):
+    """
+    Same as band_correction_interior for the first and last rows and columns of the band, with one thread per
+    border pixel: first the two rows, then the inner part of the two columns.
+    """
     tx = cuda.threadIdx.x
     bx = cuda.blockIdx.x
     bd = cuda.blockDim.x
-    pos = bx * bd + tx
-    if pos < image.shape[0]:
-        image_float = numba.float32(image[pos])
-        first = image_float * kernel[pos] - black[pos] * 0.8
-        white_float = numba.float32(white[pos])
-        second = white_float * kernel[pos] - black[pos] * 0.8
-        value = first / second
-        if value < 0:
-            value = 0
-        elif value > 1:
-            value = 1
-        reflectance[pos] = value * 4095
+    border_pos = bx * bd + tx
+    if border_pos < 2 * cols + 2 * (rows - 2):
+        if border_pos < 2 * cols:
+            row = (border_pos // cols) * (rows - 1)
+            col_index = border_pos % cols
+        else:
+            row = (border_pos - 2 * cols) % (rows - 2) + 1
+            col_index = ((border_pos - 2 * cols) // (rows - 2)) * (cols - 1)
+        pos = start + row * cols + col_index
+        if band_type == 0:
+            value = red_demosaicing(image, scale, offset, pos, row, col_index, rows, cols)
+        elif band_type == 2:
+            value = blue_demosaicing(image, scale, offset, pos, row, col_index, rows, cols)
+        else:
+            value = nir_filtering(image, scale, offset, pos, row, col_index, f00, f01, f10, f11)
+        out_image[pos] = to_12_bits(value)
 
 
 def get_arguments() -> Namespace:
@@ -267,40 +296,156 @@ def get_arguments() -> Namespace:
 
 def select_interpolation_type(white_ref: np.ndarray, current_res) -> list:
     white_resh = white_ref.reshape(4, current_res["band_height"], current_res["band_width"])
-    type_list = []
-    for i in range(white_resh.shape[0]):
-        half_height = int(current_res["band_height"] / 2)
-        half_width = int(current_res["band_width"] / 2)
-        pixel_square = white_resh[i, half_height:half_height + 2, half_width:half_width + 2]
-
-        pixel_square = pixel_square / np.max(pixel_square)
-        matrix = np.where(pixel_square > 0.9, True, False)
-
-        if np.all(matrix == np.array([[False, False], [False, True]])):
-            # Great response in the red filter
-            type_list.append(0)
-        elif np.all(matrix == np.array([[False, True], [True, False]])):
-            # Great response in the green filter
-            type_list.append(1)
-        elif np.all(matrix == np.array([[True, False], [False, False]])):
-            # Great response in the blue filter
-            type_list.append(2)
-        elif np.all(matrix == np.array([[True, True], [True, True]])):
-            # Great response in all filters
-            type_list.append(3)
-    return type_list
+    half_height = current_res["band_height"] // 2
+    half_width = current_res["band_width"] // 2
+    pixel_squares = white_resh[:, half_height:half_height + 2, half_width:half_width + 2]
+    matrices = pixel_squares / pixel_squares.max(axis=(1, 2), keepdims=True) > 0.9
+    # Each 2x2 response pattern is packed in 4 bits: top-left, top-right, bottom-left, bottom-right
+    codes = (matrices[:, 0, 0] << 3) | (matrices[:, 0, 1] << 2) | (matrices[:, 1, 0] << 1) | matrices[:, 1, 1]
+    # Bands with an unknown response keep their position with type -1, so they are not corrected
+    return [INTERPOLATION_TYPES.get(code, -1) for code in codes.tolist()]
+
+
+def reflectance_coefficients(white_ref: np.ndarray, black_ref: np.ndarray) -> Tuple[np.ndarray, np.ndarray]:
+    """
+    Precompute the per pixel scale and offset that turn the reflectance calibration into a single multiply-add
+    params:
+        white_ref   : White calibration image
+        black_ref   : Black calibration image
+    returns:
+        float32 scale and offset, so that
+        image * scale + offset = (image - black * 0.8) / (white - black * 0.8)
+    """
+    # The calibration is cast to float32 once, so it is not promoted again on every pixel of every frame
+    black_level = black_ref.astype(np.float32) * np.float32(0.8)
+    denominator = white_ref.astype(np.float32) - black_level
+    return (1 / denominator).astype(np.float32), (-black_level / denominator).astype(np.float32)
 
 
 def calculate_filter_kernel(white_ref: np.ndarray, current_res) -> np.ndarray:
     white_resh = white_ref.reshape(4, current_res["band_height"], current_res["band_width"])
-    kernel = np.empty((4, 2, 2), dtype=np.float32)
-    for i in range(4):
-        half_width = int(current_res["band_width"] / 2)
-        half_height = int(current_res["band_height"] / 2)
-        band_max = np.max(white_resh[i, :, :].astype(np.float32))
-        band_kernel = band_max / white_resh[i, :, :]
-        kernel[i, :, :] = band_kernel[half_height:half_height + 2, half_width:half_width + 2]
-    return kernel
+    half_width = current_res["band_width"] // 2
+    half_height = current_res["band_height"] // 2
+    band_max = white_resh.reshape(4, -1).max(axis=1).astype(np.float32)[:, None, None]
+    # Only the central 2x2 square of each band is needed, so the rest of the band is not divided
+    return band_max / white_resh[:, half_height:half_height + 2, half_width:half_width + 2]
+
+
+class FrameSlot:
+    """Host and device buffers, and the CUDA stream, used to correct one frame independently of the others"""
+
+    def __init__(self, image_size: int):
+        self.stream = cuda.stream()
+        # Bands are independent and write disjoint regions of the corrected image, so each one has its own stream
+        self.band_streams = [cuda.stream() for _ in range(4)]
+        self.upload_done = cuda.event(timing=False)
+        self.band_done = [cuda.event(timing=False) for _ in range(4)]
+        self.raw_h = cuda.pinned_array(image_size, dtype=np.uint16)
+        self.raw_d = cuda.device_array(image_size, dtype=np.uint16)
+        # The corrected image is zeroed only once because bands without a matching interpolation (green) are never
+        # written. It is stored in 12 bits, so half the bytes of a float32 image are copied back.
+        self.corrected_d = cuda.to_device(np.zeros(image_size, dtype=np.uint16), stream=self.stream)
+        self.corrected_h = cuda.pinned_array(image_size, dtype=np.uint16)
+        self.launches = []
+        self.index = -1
+        # Future of the read and the launches of the frame currently assigned to the slot
+        self.pending = None
+
+
+class CalibrationPipeline:
+    """Apply the reflectance calibration and the band correction to raw images on the GPU. Each frame is processed
+    in its own slot, so the read, transfers and kernels of a frame overlap with the ones of the frame being shown.
+    """
+
+    def __init__(self, current_res: dict, black_cal: np.ndarray, white_cal: np.ndarray, slot_count: int = 3):
+        self.band_shape = (4, current_res["band_height"], current_res["band_width"])
+        image_size = current_res["height"] * current_res["width"]
+        self.band_size = current_res["band_width"] * current_res["band_height"]
+
+        # Warp-wide rows of 32 threads keep the reads of each row coalesced
+        self.threads_per_block = (32, TPB_DEMOSAIC // 32)
+        self.correction_blocks_per_grid = (
+            (current_res["band_width"] - 2 + self.threads_per_block[0] - 1) // self.threads_per_block[0],
+            (current_res["band_height"] - 2 + self.threads_per_block[1] - 1) // self.threads_per_block[1])
+        self.border_threads_per_block = TPB_DEMOSAIC
+        border_size = 2 * current_res["band_width"] + 2 * (current_res["band_height"] - 2)
+        self.border_blocks_per_grid = (border_size + self.border_threads_per_block - 1) // self.border_threads_per_block
+        # CUDA limit of threads per block
+        assert self.threads_per_block[0] * self.threads_per_block[1] <= 1024
+        assert self.border_threads_per_block <= 1024
+
+        self.type_list = select_interpolation_type(white_cal, current_res)
+        filter_list = calculate_filter_kernel(white_cal, current_res)
+        scale, offset = reflectance_coefficients(white_cal, black_cal)
+        self.scale_d = cuda.to_device(scale)
+        self.offset_d = cuda.to_device(offset)
+        # The NIR filters are passed to the kernels as scalars instead of being uploaded as arrays
+        self.filter_list = [tuple(band_filter.flatten()) for band_filter in filter_list]
+
+        self.slots = [FrameSlot(image_size) for _ in range(slot_count)]
+        for slot in self.slots:
+            slot.launches = self.build_launch_sequence(slot)
+        # Files are read and their work issued to the GPU by a single worker thread, so the display is never blocked
+        # by the disk
+        self.worker = ThreadPoolExecutor(max_workers=1)
+
+    def build_launch_sequence(self, slot: FrameSlot) -> list:
+        """Prepare the kernels and stream synchronizations issued for every frame of a slot. Buffers, grid sizes and
+        streams do not change between frames, so the kernels are specialized and configured once and replayed with a
+        single call each, which is the closest Numba gets to capturing the sequence in a CUDA graph.
+        """
+        launches = [(slot.upload_done.record, (slot.stream,))]
+        for i, image_type in enumerate(self.type_list):
+            # Green bands (1) are not corrected
+            if image_type not in (0, 2, 3):
+                continue
+            band_stream = slot.band_streams[i]
+            launches.append((slot.upload_done.wait, (band_stream,)))
+            # Band geometry is passed as scalars, which the driver keeps in the kernel parameter space
+            kernel_args = (
+                slot.raw_d, self.scale_d, self.offset_d, slot.corrected_d,
+                i * self.band_size, self.band_shape[1], self.band_shape[2], image_type, *self.filter_list[i])
+            launches.append((
+                band_correction_interior.specialize(*kernel_args)[
+                    self.correction_blocks_per_grid, self.threads_per_block, band_stream],
+                kernel_args))
+            launches.append((
+                band_correction_border.specialize(*kernel_args)[
+                    self.border_blocks_per_grid, self.border_threads_per_block, band_stream],
+                kernel_args))
+            # The copy back to the host waits for every band of the frame
+            launches.append((slot.band_done[i].record, (band_stream,)))
+            launches.append((slot.band_done[i].wait, (slot.stream,)))
+        return launches
+
+    def enqueue(self, index: int, path: str):
+        """Read the image and launch its correction in the background, unless it is already in a slot"""
+        if any(slot.index == index for slot in self.slots):
+            return
+        # The slot holding the frame furthest from the requested one is reused
+        slot = max(self.slots, key=lambda s: abs(s.index - index) if s.index >= 0 else np.inf)
+        slot.index = index
+        slot.pending = self.worker.submit(self.process, slot, path)
+
+    def process(self, slot: FrameSlot, path: str):
+        """Executed in the worker thread. Fill the slot with the image and issue its correction to the slot streams"""
+        slot.stream.synchronize()
+        read_raw_into(path, slot.raw_h)
+        slot.raw_d.copy_to_device(slot.raw_h, stream=slot.stream)
+        for operation, operation_args in slot.launches:
+            operation(*operation_args)
+        slot.corrected_d.copy_to_host(slot.corrected_h, stream=slot.stream)
+
+    def get_frame(self, index: int) -> np.ndarray:
+        """Wait only for the stream of the requested frame and return it split in bands. The returned array is a view
+        of the slot buffer, valid until the slot is reused by enqueue."""
+        slot = next(slot for slot in self.slots if slot.index == index)
+        slot.pending.result()
+        slot.stream.synchronize()
+        return slot.corrected_h.reshape(self.band_shape)
+
+    def close(self):
+        self.worker.shutdown()
 
 
 def main():
@@ -320,51 +465,32 @@ def main():
         print("Input folder not found")
         return False
 
-    image_path_list = input_path.glob("*.raw")
+    # The frame number of each file is parsed once, and only the sorted paths are kept
+    image_entries = []
+    with os.scandir(input_path) as entries:
+        for entry in entries:
+            stem, extension = os.path.splitext(entry.name)
+            if extension == ".raw":
+                image_entries.append((int(stem), entry.path))
+    image_entries.sort()
+    image_path_sorted = [path for _, path in image_entries]
     index = 0
-    image_path_sorted = sorted(image_path_list, key=lambda x: int(x.stem))
     image_display.setup_window("Arducam")
 
     if args.cal:
-        threads_per_block = 256
-        blocks_per_grid = int(
-            np.ceil(
-                (current_res["height"] * current_res["width"] + threads_per_block - 1) / threads_per_block))
-        correction_blocks_per_grid = int(
-            np.ceil(
-                (current_res["band_height"] * current_res["band_width"] + threads_per_block - 1) / threads_per_block))
-        black_cal = np.fromfile(args.black_calibration, dtype=np.uint16)
-        white_cal = np.fromfile(args.white_calibration, dtype=np.uint16)
-        type_list = select_interpolation_type(white_cal, current_res)
-        filter_list = calculate_filter_kernel(white_cal, current_res)
-        black_d = cuda.to_device(black_cal)
-        white_d = cuda.to_device(white_cal)
+        image_size = current_res["height"] * current_res["width"]
+        # Page-locked host buffers are transferred by DMA without the driver's pageable staging copy
+        black_cal = cuda.pinned_array(image_size, dtype=np.uint16)
+        white_cal = cuda.pinned_array(image_size, dtype=np.uint16)
+        read_raw_into(args.black_calibration, black_cal)
+        read_raw_into(args.white_calibration, white_cal)
+        pipeline = CalibrationPipeline(current_res, black_cal, white_cal)
         while True:
-            raw = np.fromfile(image_path_sorted[index], dtype=np.uint16)
-            raw_d = cuda.to_device(raw)
-            reflectance = np.zeros(shape=current_res["width"] * current_res["height"], dtype=np.float32)
-            ref_d = cuda.to_device(reflectance)
-            gpu_reflectance[blocks_per_grid, threads_per_block](raw_d, white_d, black_d, ref_d)
-            corrected_image = np.zeros(shape=current_res["width"] * current_res["height"], dtype=np.float32)
-            corrected_d = cuda.to_device(corrected_image)
-            for i, image_type in enumerate(type_list):
-                arr = np.array([
-                    i * current_res["band_width"] * current_res["band_height"],
-                    current_res["band_width"] * current_res["band_height"],
-                    current_res["band_height"],
-                    current_res["band_width"]
-                ], dtype=np.uint32)
-                image_data = cuda.to_device(arr)
-                if image_type == 0:
-                    red_demosaicing[correction_blocks_per_grid, threads_per_block](ref_d, corrected_d, image_data)
-                elif image_type == 2:
-                    blue_demosaicing[correction_blocks_per_grid, threads_per_block](ref_d, corrected_d, image_data)
-                elif image_type == 3:
-                    current_filter = filter_list[i].flatten()
-                    filter_d = cuda.to_device(current_filter)
-                    nir_filtering[correction_blocks_per_grid, threads_per_block](ref_d, corrected_d, image_data, filter_d)
-
-            image = corrected_d.copy_to_host().reshape(4, current_res["band_height"], current_res["band_width"])*4095
+            pipeline.enqueue(index, image_path_sorted[index])
+            # The next frame is read and corrected while the current one is still being processed
+            if index < len(image_path_sorted) - 1:
+                pipeline.enqueue(index + 1, image_path_sorted[index + 1])
+            image = pipeline.get_frame(index)
             key = image_display.study_frame("Arducam", image, index)
             if key == ord('a') and index > 0:
                 index -= 1
@@ -372,10 +498,15 @@ def main():
                 index += 1
             elif key == ord('q'):
                 break
+        pipeline.close()
 
     elif args.raw:
+        # The current frame and its neighbours stay decoded, so going back and forth does not read them again
+        image_cache = {}
         while True:
-            image = read_arducam_image(image_path_sorted[index], current_res)
+            if index not in image_cache:
+                image_cache[index] = read_arducam_image(image_path_sorted[index], current_res)
+            image = image_cache[index]
             key = image_display.study_frame("Arducam", image, index)
             if key == ord('a') and index > 0:
                 index -= 1
@@ -383,6 +514,8 @@ def main():
                 index += 1
             elif key == ord('q'):
                 break
+            for cached_index in [i for i in image_cache if abs(i - index) > 1]:
+                del image_cache[cached_index]
 
 
 if __name__ == "__main__":
@@ -1,23 +1,29 @@
 import io
+import os
 
 import numpy as np
 import socket
 import threading
 import queue
+import selectors
 import time
-import select
 from pathlib import Path
 from argparse import ArgumentParser, Namespace
+from typing import List
 from src.utils import (
     generate_new_capturing_folder,
     ComputerScreen,
     show_image,
     generate_arducam_mosaic,
+    CudaMosaic,
+    SPSCQueue,
+    set_receive_timeout,
 )
 from src.terminal_tcp_interface import (
     UserAction,
     Message,
     print_terminal,
+    log_thread,
     terminal_input,
     send_message
 )
@@ -31,8 +37,16 @@ resolution_map = {
 TCP_PORT = 32233
 TCP_MSG_PORT = 32211
 TCP_CONF_PORT = 32121
-IMG_BYTES = 4371840
 LOOP_TIMEOUT = 2
+SOCKET_BUFFER_BYTES = 8 * 1024 * 1024
+BUFFER_POOL_SIZE = 4
+SAVE_THREADS = 2
+DISPLAY_FRAMERATE = 5
+
+
+def get_image_bytes(current_res: dict) -> int:
+    """Size in bytes of the images sent by the camera, 4 bands of uint16 pixels"""
+    return 4 * current_res["band_height"] * current_res["band_width"] * np.dtype(np.uint16).itemsize
 
 
 def get_arguments() -> Namespace:
@@ -58,6 +72,12 @@ def get_arguments() -> Namespace:
         required=False,
         action='store_true')
 
+    parser.add_argument(
+        "--gpu",
+        help="Generate the mosaic of the shown images in the GPU.",
+        required=False,
+        action='store_true')
+
     parser.add_argument(
         "-o",
         "--output_folder",
@@ -82,92 +102,141 @@ def get_arguments() -> Namespace:
 
 def receive_thread(server_ip: str,
                    server_port: int,
-                   data_queue: queue.Queue,
+                   current_res: dict,
+                   buffer_pool: List[bytearray],
+                   free_queue: SPSCQueue,
+                   image_queue: SPSCQueue,
+                   log_queue: queue.SimpleQueue,
                    client_connected: threading.Event,
                    start: threading.Event,
                    finish: threading.Event):
+    """Receives the images sent by the camera and decodes them in place. Every frame is received in a buffer of the pool
+    and queued as an uint16 view of it, so no data is copied between receiving and processing.
+
+    input:
+        * server_ip: IP in which the image server is started.
+        * server_port: port in which the image server is started.
+        * current_res: resolution of the images sent by the camera.
+        * buffer_pool: preallocated buffers in which the images are received.
+        * free_queue: indices of the buffers that can be used to receive a new image.
+        * image_queue: decoded images with the index of the buffer that holds them.
+        * log_queue: messages to be printed by the logging thread.
+        * client_connected: event that tells if the camera is connected.
+        * start: event that tells if the images should be received. It is cleared when the camera stops sending.
+        * finish: event that tells if the thread should stop.
+
+    return:
+        None"""
     img_server = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+    # Set before listening so the accepted client inherits it and the window scaling is negotiated for it
+    img_server.setsockopt(socket.SOL_SOCKET, socket.SO_RCVBUF, SOCKET_BUFFER_BYTES)
     img_server.bind((server_ip, server_port))
+    img_server.listen(1)
+    # Registered once, waiting for the camera connection with a timeout so start and finish are checked regularly
+    server_selector = selectors.DefaultSelector()
+    server_selector.register(img_server, selectors.EVENT_READ)
     try:
+        img_bytes = get_image_bytes(current_res)
+        # Views of every buffer of the pool, created once and reused for all the received images
+        image_shape = (4, current_res["band_height"], current_res["band_width"])
+        buffer_views = [memoryview(buffer) for buffer in buffer_pool]
+        buffer_images = [np.frombuffer(buffer, dtype=np.uint16).reshape(image_shape) for buffer in buffer_pool]
+        for image in buffer_images:
+            # The images share memory with the pooled buffers, consumers must not modify them
+            image.flags.writeable = False
         while not finish.is_set():
-            if start.is_set():
-                img_server.listen(1)
+            if start.wait(LOOP_TIMEOUT) and server_selector.select(LOOP_TIMEOUT):
                 img_client, _ = img_server.accept()
+                img_client.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+                # Blocking socket with a kernel receive timeout, so MSG_WAITALL fills the whole image in a single call
+                img_client.setblocking(True)
+                set_receive_timeout(img_client, LOOP_TIMEOUT)
+                if hasattr(socket, "TCP_QUICKACK"):
+                    img_client.setsockopt(socket.IPPROTO_TCP, socket.TCP_QUICKACK, 1)
+                # The kernel clips the buffer to net.core.rmem_max
+                if img_client.getsockopt(socket.SOL_SOCKET, socket.SO_RCVBUF) < img_bytes:
+                    log_queue.put((1, "The socket receive buffer is smaller than an image, increase net.core.rmem_max."))
+                recv_into = img_client.recv_into
                 client_connected.set()
                 mean_time = 0
                 count = 0
                 while start.is_set():
+                    try:
+                        buffer_index = free_queue.get(timeout=LOOP_TIMEOUT)
+                    except queue.Empty:
+                        continue
+                    image_view = buffer_views[buffer_index]
                     start_time = time.perf_counter_ns()
-                    bytes_to_receive = IMG_BYTES
-                    loop_timeout = 0
-                    image_data = bytes()
-                    while bytes_to_receive > 0 and loop_timeout < LOOP_TIMEOUT:
-                        start_loop = time.time()
-                        r, _, _ = select.select([img_client], [], [])
-                        if r:
-                            data = img_client.recv(bytes_to_receive)
-
-                            if data:
-                                image_data += data
-                                bytes_to_receive -= len(data)
-                        loop_timeout += time.time() - start_loop
-                    data_queue.put(image_data)
-                    mean_time += time.perf_counter_ns() - start_time
-                    if loop_timeout < LOOP_TIMEOUT:
+                    offset = 0
+                    while offset < img_bytes:
+                        try:
+                            received = recv_into(image_view[offset:], img_bytes - offset, socket.MSG_WAITALL)
+                        except BlockingIOError:
+                            # No data for LOOP_TIMEOUT, the camera stopped sending
+                            break
+                        if received == 0:
+                            break
+                        offset += received
+                    if offset == img_bytes:
+                        image_queue.put((buffer_index, buffer_images[buffer_index]))
+                        mean_time += time.perf_counter_ns() - start_time
                         count += 1
+                    else:
+                        # The camera stopped sending or closed the connection
+                        free_queue.put(buffer_index)
+                        start.clear()
 
                 img_client.close()
+                client_connected.clear()
                 if count != 0:
                     mean_time /= count
-                    print_terminal(0, f"Mean time elapsed receiving {count} images:  {mean_time / 1000000} ms")
+                    log_queue.put((0, f"Mean time elapsed receiving {count} images:  {mean_time / 1000000} ms"))
 
     except Exception as e:
-        print(e)
+        log_queue.put((1, str(e)))
 
     finally:
+        server_selector.close()
         img_server.close()
         client_connected.clear()
-        print_terminal(0, "Image receiving thread finished correctly.")
+        log_queue.put((0, "Image receiving thread finished correctly."))
         return
 
 
-def decode_thread(current_res: dict,
-                  data_queue: queue.Queue,
-                  image_queue: queue.Queue,
-                  client_connected: threading.Event,
-                  start: threading.Event,
-                  finish: threading.Event):
-    while not finish.is_set():
-        count = 0
-        mean_time = 0
-        while not client_connected.is_set():
-            if finish.is_set():
-                return
-
-        while start.is_set():
-            start_time = time.perf_counter_ns()
-            image = np.empty((IMG_BYTES,), dtype=np.uint8)
-            loop_timeout = 0
-            while loop_timeout < LOOP_TIMEOUT:
-                start_loop = time.time()
-                if not data_queue.empty():
-                    data = data_queue.get()
-                    if len(data) != 0:
-                        image[:] = np.frombuffer(data, np.uint8)
-                        break
-                loop_timeout += time.time() - start_loop
-            image = image.view(np.uint16)
-            image_reshaped = image.reshape((4, current_res["band_height"], current_res["band_width"]))
-            image_queue.put(image_reshaped)
-            mean_time += time.perf_counter_ns() - start_time
-            if loop_timeout < LOOP_TIMEOUT:
-                count += 1
-            else:
-                start.clear()
-        if count != 0:
-            mean_time /= count
-            print_terminal(0, f"Mean time elapsed processing {count} images:  {mean_time / 1000000} ms")
-    print_terminal(0, "Image decoding thread finished correctly.")
+def save_thread(buffer_pool: List[bytearray],
+                free_queue: SPSCQueue,
+                save_queue: queue.Queue,
+                log_queue: queue.SimpleQueue,
+                finish: threading.Event):
+    """Writes the received images to disk, so the main loop is not blocked by the file writes. The pooled buffer is
+    written directly and returned to the pool afterwards.
+
+    input:
+        * buffer_pool: preallocated buffers in which the images are received.
+        * free_queue: indices of the buffers that can be used to receive a new image.
+        * save_queue: index of the buffer to be saved and path of the output file.
+        * log_queue: messages to be printed by the logging thread.
+        * finish: event that tells if the thread should stop. Pending images are saved before finishing.
+
+    return:
+        None"""
+    while not finish.is_set() or not save_queue.empty():
+        try:
+            buffer_index, file_path = save_queue.get(timeout=LOOP_TIMEOUT)
+        except queue.Empty:
+            continue
+        image_view = memoryview(buffer_pool[buffer_index])
+        fd = os.open(file_path, os.O_WRONLY | os.O_CREAT | os.O_TRUNC, 0o644)
+        try:
+            written = 0
+            while written < len(image_view):
+                written += os.write(fd, image_view[written:])
+        finally:
+            os.close(fd)
+            image_view.release()
+            free_queue.put(buffer_index)
+            save_queue.task_done()
+    log_queue.put((0, "Image saving thread finished correctly."))
     return
 
 
@@ -198,8 +267,10 @@ def main():
         ),
     ]
 
-    data_queue = queue.Queue()
-    image_queue = queue.Queue()
+    free_queue = SPSCQueue()
+    image_queue = SPSCQueue()
+    save_queue = queue.Queue()
+    log_queue = queue.SimpleQueue()
     msg_queue = queue.Queue()
     process_msg_queue = queue.Queue()
     client_event = threading.Event()
@@ -214,6 +285,11 @@ def main():
         print("Input resolution not implemented")
         return
 
+    # Frames are received in a fixed pool of buffers, the queues only carry the buffer indices
+    buffer_pool = [bytearray(get_image_bytes(current_res)) for _ in range(BUFFER_POOL_SIZE)]
+    for buffer_index in range(BUFFER_POOL_SIZE):
+        free_queue.put(buffer_index)
+
     # Sending configuration to Raspberry
     cnf_server = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
     cnf_server.bind((args.ip, TCP_CONF_PORT))
@@ -254,25 +330,43 @@ def main():
         screen_size = ComputerScreen.get_screen_size(0)
         screen = ComputerScreen(*screen_size)
         window_size = screen.get_width_with_aspect_ratio(*image_shape)
-        window_size = (int(window_size[1] * 0.95), int(window_size[0] * 0.95))
+        window_size = (int(window_size[0] * 0.95), int(window_size[1] * 0.95))
+    gpu_mosaic = None
+    mosaic_buffer = None
+    if not args.no_show:
+        if args.gpu:
+            gpu_mosaic = CudaMosaic((4, current_res["band_height"], current_res["band_width"]))
+        else:
+            mosaic_buffer = np.empty((2 * current_res["band_height"], 2 * current_res["band_width"]), dtype=np.uint8)
+            # Loads or compiles the mosaic kernel before the capture starts, instead of delaying the first frame. The
+            # received images are read-only and numba compiles them apart, so the warm-up image has to be one as well
+            warm_up_image = np.zeros((4, current_res["band_height"], current_res["band_width"]), dtype=np.uint16)
+            warm_up_image.flags.writeable = False
+            generate_arducam_mosaic(warm_up_image, mosaic_buffer)
 
     show_count = 0
     save_count = 0
-    skip_count = 0
-    frames_to_skip = np.floor(current_res["framerate"]/5)
+    display_period = 10**9 // DISPLAY_FRAMERATE
     mean_call_time = 0
     call_time = 0
     _threads = [
         threading.Thread(target=terminal_input, args=(user_action_map, process_msg_queue,)),
         threading.Thread(target=send_message, args=(msg_conn, msg_queue, finish_event,)),
         threading.Thread(target=receive_thread,
-                         args=(args.ip, TCP_PORT, data_queue, client_event, start_event, finish_event,)),
-        threading.Thread(target=decode_thread,
-                         args=(current_res,
-                               data_queue, image_queue, client_event, start_event, finish_event,)),
+                         args=(args.ip, TCP_PORT, current_res, buffer_pool, free_queue,
+                               image_queue, log_queue, client_event, start_event, finish_event,)),
+    ]
+    # Several writes in flight, so a slow disk write does not hold the next images in the pool
+    _threads += [
+        threading.Thread(target=save_thread, args=(buffer_pool, free_queue, save_queue, log_queue, finish_event,))
+        for _ in range(SAVE_THREADS)
     ]
 
+    # Started on its own, it has to print the messages of the other threads until all of them have finished
+    _log_thread = threading.Thread(target=log_thread, args=(log_queue,))
+
     try:
+        _log_thread.start()
         for thread in _threads:
             thread.start()
         while not finish_event.is_set():
@@ -298,11 +392,11 @@ def main():
                     # Wait for all the data to be saved in the file
                     if args.save:
                         while not image_queue.empty():
-                            image = image_queue.get()
+                            buffer_index, image = image_queue.get()
                             filename = f"{save_count:08d}.raw"
-                            file_path = capturing_folder.joinpath(filename)
-                            image.tofile(file_path)
+                            save_queue.put((buffer_index, capturing_folder.joinpath(filename)))
                             save_count += 1
+                        save_queue.join()
                     if show_count != 0:
                         print_terminal(0, f"Mean time between calls to show image: {mean_call_time/show_count/10**6} ms")
                         
@@ -318,24 +412,26 @@ def main():
                         msg_queue.put(current_msg)
 
             if not image_queue.empty():
-                image = image_queue.get()
-                if not args.no_show:
-                    if skip_count == frames_to_skip:
-                        mosaic = generate_arducam_mosaic(image)
-                        show_image("Arducam", mosaic, 0, window_size, (100, 100))
-                        if call_time != 0:
-                            mean_call_time += time.perf_counter_ns() - call_time
-                        call_time = time.perf_counter_ns()
-                        show_count += 1
-                        skip_count = 0
+                buffer_index, image = image_queue.get()
+                # Images are shown at most at DISPLAY_FRAMERATE, the rest are only saved or dropped
+                if not args.no_show and time.perf_counter_ns() - call_time >= display_period:
+                    if gpu_mosaic is not None:
+                        mosaic = gpu_mosaic.generate(image)
                     else:
-                        skip_count += 1
+                        mosaic = generate_arducam_mosaic(image, out=mosaic_buffer)
+                    show_image("Arducam", mosaic, 1, window_size, (100, 100))
+                    if call_time != 0:
+                        mean_call_time += time.perf_counter_ns() - call_time
+                    call_time = time.perf_counter_ns()
+                    show_count += 1
 
                 if args.save:
+                    # The saving thread returns the buffer to the pool once it has been written
                     filename = f"{save_count:08d}.raw"
-                    file_path = capturing_folder.joinpath(filename)
-                    image.tofile(file_path)
+                    save_queue.put((buffer_index, capturing_folder.joinpath(filename)))
                     save_count += 1
+                else:
+                    free_queue.put(buffer_index)
 
     except KeyboardInterrupt:
         print("Code finished")
@@ -347,6 +443,9 @@ def main():
         for _thread in _threads:
             if _thread.is_alive():
                 _thread.join()
+        log_queue.put(None)
+        if _log_thread.is_alive():
+            _log_thread.join()
 
 
 if __name__ == '__main__':
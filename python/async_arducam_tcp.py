@@ -1,31 +1,80 @@
+import os
 import numpy as np
-import cv2 as cv
 import asyncio
+import socket
+import queue
+import threading
 import time
 from pathlib import Path
 from argparse import ArgumentParser, Namespace
+from concurrent.futures import Executor, ThreadPoolExecutor
+from dataclasses import dataclass, field
+from typing import Callable, List, Optional, Tuple
 from src.utils import (
     generate_new_capturing_folder,
     ImageDisplay,
+    AsyncSPSCQueue,
+    generate_arducam_mosaic,
+    set_receive_timeout,
 )
 from src.async_terminal_tcp import (
     UserAction,
     print_terminal,
+    log_thread,
     async_terminal,
     message_server
 )
 
+@dataclass(frozen=True, slots=True)
+class Resolution:
+    """Size of the images of a camera mode. The band sizes and the size in bytes of the image are computed once, as the
+    received images have 4 bands of 2 bytes per pixel.
+
+    The camera sends the bands one after the other (band planar), which is also the layout of the saved files and the
+    one expected by the mosaic, so the received buffers are used with band_shape as they are, without transposing"""
+    width: int
+    height: int
+    framerate: int
+    band_width: int = field(init=False)
+    band_height: int = field(init=False)
+    band_shape: Tuple[int, int, int] = field(init=False)
+    image_bytes: int = field(init=False)
+
+    def __post_init__(self):
+        object.__setattr__(self, "band_width", self.width // 2)
+        object.__setattr__(self, "band_height", self.height // 2)
+        object.__setattr__(self, "band_shape", (4, self.band_height, self.band_width))
+        object.__setattr__(self, "image_bytes", self.band_width * self.band_height * 4 * 2)
+
+
 resolution_map = {
-    "LOW": {"width": 1328, "height": 990, "band_width": int(1328 / 2), "band_height": int(990 / 2), "framerate": 30},
-    "MEDIUM": {"width": 2024, "height": 1520, "band_width": int(2024 / 2), "band_height": int(1520 / 2),
-               "framerate": 15},
-    "HIGH": {"width": 4056, "height": 3040, "band_width": int(4056 / 2), "band_height": int(3040 / 2), "framerate": 5}
+    "LOW": Resolution(1328, 990, 30),
+    "MEDIUM": Resolution(2024, 1520, 15),
+    "HIGH": Resolution(4056, 3040, 5)
+}
+
+# Configuration sent to the camera for each resolution
+CONF_MESSAGES = {
+    "LOW": "--mode 1332:990:10:U --resolution LOW".encode('utf-8'),
+    "MEDIUM": "--mode 2028:1520:12:U --resolution MEDIUM".encode('utf-8'),
+    "HIGH": "--mode 4056:3040:12:U --resolution HIGH".encode('utf-8')
 }
 
 TCP_PORT = 32233
 TCP_MSG_PORT = 32211
 TCP_CONF_PORT = 32121
 LOOP_TIMEOUT = 2
+MAX_QUEUED_IMAGES = 4
+# Enough buffers to queue this many images in both queues while an image is being received, shown and saved. As the
+# queues are unbounded, the pool is what makes the receiver wait when the consumers fall behind
+BUFFER_POOL_SIZE = MAX_QUEUED_IMAGES * 2 + 3
+# The pool is capped by this budget, a full pool is about 29 MB at LOW, 68 MB at MEDIUM and 271 MB at HIGH, which gets
+# 5 buffers of 24.7 MB instead. It never goes below one image being received, one shown and one saved
+BUFFER_POOL_BYTES = 128 * 1024 * 1024
+MIN_BUFFER_POOL_SIZE = 3
+# Bytes that need to be available before the socket is reported as readable
+RECV_LOW_WATER_BYTES = 1024 * 1024
+SOCKET_BUFFER_BYTES = 8 * 1024 * 1024
 
 
 def get_arguments() -> Namespace:
@@ -51,6 +100,28 @@ def get_arguments() -> Namespace:
         required=False,
         action='store_true')
 
+    parser.add_argument(
+        "--single_file",
+        help="Save all the images of a capture appended in a single file instead of a file per image.",
+        required=False,
+        action='store_true')
+
+    parser.add_argument(
+        "--receive_thread",
+        help="Receive the images in a thread with blocking calls, a call per image, instead of in the event loop.",
+        required=False,
+        action='store_true')
+
+    parser.add_argument(
+        "--pin_cpus",
+        help="CPUs in which the event loop, the image saving thread and the receiving thread (with --receive_thread) "
+             "run, e.g. 0 2 1. By default they are not pinned.",
+        type=int,
+        nargs=3,
+        required=False,
+        default=None,
+        action='store')
+
     parser.add_argument(
         "-o",
         "--output_folder",
@@ -73,47 +144,147 @@ def get_arguments() -> Namespace:
     return parser.parse_args()
 
 
-async def read_image_task(reader: asyncio.StreamReader, img_bytes: int, data_queue: asyncio.Queue):
-    mean_time = 0
+def pin_thread(cpu: int, thread_id: int = 0):
+    """Restrict a thread to a CPU, so its data stays in the same caches. Only available on linux, where it is
+    ignored if the CPU can not be used. A thread_id of 0 is the calling thread"""
+    try:
+        os.sched_setaffinity(thread_id, {cpu})
+    except (AttributeError, OSError) as e:
+        print_terminal(1, f"Couldn't pin the thread to CPU {cpu}: {e}")
+
+
+async def wait_any_event(*events: asyncio.Event):
+    """Wait until any of the events is set"""
+    waiters = [asyncio.create_task(event.wait()) for event in events]
+    try:
+        await asyncio.wait(waiters, return_when=asyncio.FIRST_COMPLETED)
+    finally:
+        for waiter in waiters:
+            waiter.cancel()
+
+
+async def read_image_task(client: socket.socket, buffer_views: List[memoryview],
+                          free_queue: AsyncSPSCQueue, data_queue: AsyncSPSCQueue, log_queue: queue.SimpleQueue):
+    loop = asyncio.get_running_loop()
+    # The images are received one after the other, so the mean time only needs the time at the end of each one
+    start_time = time.perf_counter_ns()
+    end_time = start_time
     count = 0
     camera_capturing = True
     try:
         while camera_capturing:
-            start_time = time.perf_counter_ns()
-            bytes_to_receive = img_bytes
-
-            while bytes_to_receive > 0:
-                data = await asyncio.wait_for(reader.read(bytes_to_receive), LOOP_TIMEOUT)
-                if len(data) < 5:
-                    camera_capturing = False
-                    break
-                if data:
-                    await data_queue.put(data)
-                    bytes_to_receive -= len(data)
-
-            mean_time += time.perf_counter_ns() - start_time
+            idx = await free_queue.get()
+            try:
+                received = await asyncio.wait_for(
+                    read_into_buffer(loop, client, buffer_views[idx]), LOOP_TIMEOUT * 4)
+            except BaseException:
+                free_queue.put_nowait(idx)
+                raise
+            if received != len(buffer_views[idx]):
+                # The camera closed the connection
+                free_queue.put_nowait(idx)
+                camera_capturing = False
+                continue
+            data_queue.put_nowait(idx)
+            end_time = time.perf_counter_ns()
             count += 1
 
     except Exception as e:
         raise e
 
     finally:
-        print_terminal(0, "Stopped receiving images from TCP server.")
+        log_queue.put((0, "Stopped receiving images from TCP server."))
         if count != 0:
-            mean_time /= count
-            print_terminal(0, f"Mean time elapsed receiving {count} images:  {mean_time / 1000000} ms")
+            mean_time = (end_time - start_time) / count
+            log_queue.put((0, f"Mean time elapsed receiving {count} images:  {mean_time / 1000000} ms"))
         return
 
 
-async def receive_image_callback(reader, writer, img_bytes: int,
-                                 data_queue: asyncio.Queue, client_connected: asyncio.Event):
+def read_image_thread(loop: asyncio.AbstractEventLoop, client: socket.socket, buffer_views: List[memoryview],
+                      free_queue: AsyncSPSCQueue, data_queue: AsyncSPSCQueue, log_queue: queue.SimpleQueue):
+    """Blocking version of read_image_task, run in a thread outside the event loop. Each image is received with
+    recv_into and MSG_WAITALL, a single call while the camera keeps sending, instead of a call each time the socket is
+    readable. The buffers are taken from and given to the event loop queues in a thread safe way.
+
+    input:
+        * loop: event loop that owns the queues.
+        * client: connected socket of the camera, in blocking mode. The receive timeout is set here.
+        * buffer_views: byte views of the buffer pool.
+        * free_queue: indexes of the buffers that can be filled.
+        * data_queue: indexes of the buffers that contain a received image.
+        * log_queue: messages to be printed.
+
+    return:
+        None"""
+    # Kernel receive timeout, the socket stays blocking so MSG_WAITALL fills the whole image in a single call
+    set_receive_timeout(client, LOOP_TIMEOUT * 4)
+    recv_into = client.recv_into
+    start_time = time.perf_counter_ns()
+    end_time = start_time
+    count = 0
+    try:
+        while True:
+            idx = asyncio.run_coroutine_threadsafe(free_queue.get(), loop).result()
+            view = buffer_views[idx]
+            offset = 0
+            try:
+                while offset < len(view):
+                    received = recv_into(view[offset:], len(view) - offset, socket.MSG_WAITALL)
+                    if received == 0:
+                        break
+                    offset += received
+            except BlockingIOError:
+                # Nothing received during the timeout
+                pass
+            if offset != len(view):
+                # The camera closed the connection or stopped sending
+                loop.call_soon_threadsafe(free_queue.put_nowait, idx)
+                break
+            loop.call_soon_threadsafe(data_queue.put_nowait, idx)
+            end_time = time.perf_counter_ns()
+            count += 1
+
+    finally:
+        log_queue.put((0, "Stopped receiving images from TCP server."))
+        if count != 0:
+            mean_time = (end_time - start_time) / count
+            log_queue.put((0, f"Mean time elapsed receiving {count} images:  {mean_time / 1000000} ms"))
+
+
+async def read_into_buffer(loop: asyncio.AbstractEventLoop, client: socket.socket, view: memoryview) -> int:
+    """Receive from the socket straight into the buffer until it is full or the connection is closed, returning the
+    number of bytes received. Where it is available, the low water mark makes the loop wait for large chunks instead of
+    waking up and receiving each segment that arrives, lowered for the end of the image so it is not delayed"""
+    set_low_water = hasattr(socket, "SO_RCVLOWAT")
+    low_water = 1
+    offset = 0
+    while offset < len(view):
+        if set_low_water and low_water != min(RECV_LOW_WATER_BYTES, len(view) - offset):
+            low_water = min(RECV_LOW_WATER_BYTES, len(view) - offset)
+            client.setsockopt(socket.SOL_SOCKET, socket.SO_RCVLOWAT, low_water)
+        received = await loop.sock_recv_into(client, view[offset:])
+        if received == 0:
+            break
+        offset += received
+    return offset
+
+
+async def receive_image_callback(client: socket.socket, buffer_views: List[memoryview],
+                                 free_queue: AsyncSPSCQueue, data_queue: AsyncSPSCQueue, log_queue: queue.SimpleQueue,
+                                 client_connected: asyncio.Event,
+                                 receive_executor: Optional[Executor]):
     try:
-        print_terminal(0, "Image provider client connected.")
+        log_queue.put((0, "Image provider client connected."))
         client_connected.set()
-        await asyncio.create_task(read_image_task(reader, img_bytes, data_queue))
+        if receive_executor is not None:
+            client.setblocking(True)
+            loop = asyncio.get_running_loop()
+            await loop.run_in_executor(
+                receive_executor, read_image_thread, loop, client, buffer_views, free_queue, data_queue, log_queue)
+        else:
+            await asyncio.create_task(read_image_task(client, buffer_views, free_queue, data_queue, log_queue))
 
-        writer.close()
-        await writer.wait_closed()
+        client.close()
 
         client_connected.clear()
     except Exception as e:
@@ -122,44 +293,61 @@ async def receive_image_callback(reader, writer, img_bytes: int,
 
 async def receive_image_server(server_ip: str,
                                server_port: int,
-                               img_bytes: int,
-                               data_queue: asyncio.Queue,
-                               client_connected: asyncio.Event):
+                               buffer_views: List[memoryview],
+                               free_queue: AsyncSPSCQueue,
+                               data_queue: AsyncSPSCQueue,
+                               log_queue: queue.SimpleQueue,
+                               client_connected: asyncio.Event,
+                               receive_executor: Optional[Executor]):
+    """The images are read with the raw sockets instead of a StreamReader, which would copy each image from its
+    internal buffer to a new bytes object"""
+    loop = asyncio.get_running_loop()
+    img_server = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
     try:
         print_terminal(0, "Waiting for connection to receive images...")
-        img_server = await asyncio.start_server(
-            lambda r, w: receive_image_callback(r, w, img_bytes, data_queue, client_connected),
-            server_ip, server_port, limit=(img_bytes + 1))
-        async with img_server:
-            await img_server.serve_forever()
+        img_server.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+        # Set before listening, so the accepted sockets inherit it and the TCP window can grow to it
+        img_server.setsockopt(socket.SOL_SOCKET, socket.SO_RCVBUF, SOCKET_BUFFER_BYTES)
+        img_server.bind((server_ip, server_port))
+        img_server.listen()
+        img_server.setblocking(False)
+        while True:
+            client, _ = await loop.sock_accept(img_server)
+            client.setblocking(False)
+            client.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+            if hasattr(socket, "TCP_QUICKACK"):
+                client.setsockopt(socket.IPPROTO_TCP, socket.TCP_QUICKACK, 1)
+            # The kernel clips the buffer to net.core.rmem_max, and reports twice its size to account for its overhead
+            if client.getsockopt(socket.SOL_SOCKET, socket.SO_RCVBUF) < 2 * SOCKET_BUFFER_BYTES:
+                log_queue.put((1, "The socket receive buffer is smaller than requested, increase net.core.rmem_max."))
+            await receive_image_callback(
+                client, buffer_views, free_queue, data_queue, log_queue, client_connected, receive_executor)
     except asyncio.CancelledError:
         print_terminal(0, "Image server cancelled.")
     except Exception as e:
         raise e
+    finally:
+        img_server.close()
 
 
 async def receive_task(server_ip: str,
                        server_port: int,
-                       img_bytes: int,
-                       data_queue: asyncio.Queue,
+                       buffer_views: List[memoryview],
+                       free_queue: AsyncSPSCQueue,
+                       data_queue: AsyncSPSCQueue,
+                       log_queue: queue.SimpleQueue,
                        client_connected: asyncio.Event,
-                       start: asyncio.Event,
-                       finish: asyncio.Event):
+                       finish: asyncio.Event,
+                       receive_executor: Optional[Executor]):
+    """Keeps the image server listening until the script finishes. The camera only connects after a START message, and
+    each capture is a connection, so there is no need to open and close the server for every capture"""
     img_server_task = None
     try:
-        while not finish.is_set():
-            while not finish.is_set() and not start.is_set():
-                await asyncio.sleep(0.2)
-            if finish.is_set():
-                break
-            elif start.is_set():
-                img_server_task = asyncio.create_task(
-                    receive_image_server(
-                        server_ip, server_port, img_bytes, data_queue, client_connected))
-                while start.is_set() or client_connected.is_set():
-                    await asyncio.sleep(0.2)
-                img_server_task.cancel()
-                img_server_task = None
+        img_server_task = asyncio.create_task(
+            receive_image_server(
+                server_ip, server_port, buffer_views, free_queue, data_queue, log_queue, client_connected,
+                receive_executor))
+        await finish.wait()
 
     except Exception as e:
         raise e
@@ -171,53 +359,70 @@ async def receive_task(server_ip: str,
         print_terminal(0, "Image receiving task finished correctly.")
 
 
-async def decode_task(current_res: dict,
-                      img_bytes: int,
-                      data_queue: asyncio.Queue,
-                      image_queue: asyncio.Queue,
+async def decode_task(buffer_images: List[np.ndarray],
+                      data_queue: AsyncSPSCQueue,
+                      image_queue: AsyncSPSCQueue,
+                      log_queue: queue.SimpleQueue,
                       client_connected: asyncio.Event,
                       start: asyncio.Event,
-                      finish: asyncio.Event):
+                      finish: asyncio.Event,
+                      image_sink: Optional[Callable[[int], None]] = None):
+    """When an image sink is given, each buffer index is handed to it instead of being sent to the image queue. It is
+    used while running without showing the images, to save them or just give the buffers back when they are not saved
+    either.
+
+    The images are received in place, so decoding is only picking the view of the buffer. Any per pixel processing
+    added here would run in the event loop thread and delay the receiving task: it should be a numba kernel writing to
+    a preallocated output, as the mosaic is, or be run in a process pool with the buffer pool moved to shared memory so
+    that the images are not pickled.
+
+    The end of each capture is signalled to the image queue with a single None. A capture starts with START and ends
+    when no image arrives for LOOP_TIMEOUT, the start event is cleared then so no other None is sent until the next
+    START, even if the camera is still connected."""
+    capture_open = False
     try:
         while not finish.is_set():
             count = 0
-            mean_time = 0
-            while not finish.is_set() and not client_connected.is_set():
-                await asyncio.sleep(0.2)
-
+            await wait_any_event(finish, start)
+            if finish.is_set():
+                break
+            capture_open = True
+            # The camera connects after receiving START
+            await wait_any_event(finish, client_connected)
             if finish.is_set():
                 break
 
+            start_time = time.perf_counter_ns()
+            end_time = start_time
             while True:
-                start_time = time.perf_counter_ns()
-                image = np.empty((img_bytes,), dtype=np.uint8)
-                data_received = 0
                 try:
-                    while data_received < img_bytes:
-                        data = await asyncio.wait_for(data_queue.get(), LOOP_TIMEOUT)
-                        if len(data) != 0:
-                            image[data_received:data_received + len(data)] = np.frombuffer(data, np.uint8)
-                            data_received += len(data)
-
-                    image = image.view(np.uint16)
-                    image_reshaped = image.reshape((4, current_res["band_height"], current_res["band_width"]))
-                    await image_queue.put(image_reshaped)
-                    mean_time += time.perf_counter_ns() - start_time
+                    idx = await asyncio.wait_for(data_queue.get(), LOOP_TIMEOUT)
+                    if image_sink is not None:
+                        image_sink(idx)
+                    else:
+                        # The buffer was received in place, its image view is already shaped
+                        image_queue.put_nowait((idx, buffer_images[idx]))
+                    end_time = time.perf_counter_ns()
                     count += 1
                 except asyncio.TimeoutError:
-                    print_terminal(0, "Image queue empty. Decode process finished.")
+                    log_queue.put((0, "Image queue empty. Decode process finished."))
                     start.clear()
+                    image_queue.put_nowait(None)
+                    capture_open = False
                     break
                 except Exception as e:
                     raise e
 
             if count != 0:
-                mean_time /= count
-                print_terminal(0, f"Mean time elapsed processing {count} images:  {mean_time / 1000000} ms")
+                mean_time = (end_time - start_time) / count
+                log_queue.put((0, f"Mean time elapsed processing {count} images:  {mean_time / 1000000} ms"))
 
     except Exception as e:
         raise e
     finally:
+        if capture_open:
+            # Ends a capture still waiting for images
+            image_queue.put_nowait(None)
         print_terminal(0, "Image decoding task finished correctly.")
 
 
@@ -227,35 +432,36 @@ async def control_task(
         client_event: asyncio.Event,
         start_event: asyncio.Event,
         finish_event: asyncio.Event):
+    async def close(current_msg):
+        finish_event.set()
+        await msg_queue.put(current_msg)
+        await asyncio.sleep(1)
+        client_event.clear()
+        start_event.clear()
+
+    async def start(current_msg):
+        start_event.set()
+        await asyncio.sleep(0.5)
+        await msg_queue.put(current_msg)
+
+    async def stop(current_msg):
+        await msg_queue.put(current_msg)
+
+    async def exposure(current_msg):
+        # Checks if image thread has been initialized or is currently receiving images
+        if start_event.is_set():
+            print_terminal(1, f"Can't set exposure while capturing.")
+        else:
+            print_terminal(0, f"Setting exposure to: {current_msg.value} us")
+            await msg_queue.put(current_msg)
+
+    handlers = {"CLOSE": close, "START": start, "STOP": stop, "EXPOSURE": exposure}
     try:
         while not finish_event.is_set():
-
-            if not process_msg_queue.empty():
-                current_msg = await process_msg_queue.get()
-                if current_msg.key == "CLOSE":
-                    finish_event.set()
-                    await msg_queue.put(current_msg)
-                    await asyncio.sleep(1)
-                    client_event.clear()
-                    start_event.clear()
-                    return
-
-                elif current_msg.key == "START":
-                    start_event.set()
-                    await asyncio.sleep(0.5)
-                    await msg_queue.put(current_msg)
-
-                elif current_msg.key == "STOP":
-                    await msg_queue.put(current_msg)
-
-                elif current_msg.key == "EXPOSURE":
-                    # Checks if image thread has been initialized or is currently receiving images
-                    if start_event.is_set():
-                        print_terminal(1, f"Can't set exposure while capturing.")
-                    else:
-                        print_terminal(0, f"Setting exposure to: {current_msg.value} us")
-                        await msg_queue.put(current_msg)
-            await asyncio.sleep(0.1)
+            current_msg = await process_msg_queue.get()
+            handler = handlers.get(current_msg.key)
+            if handler is not None:
+                await handler(current_msg)
 
     except Exception as e:
         raise e
@@ -263,15 +469,94 @@ async def control_task(
         print_terminal(0, "Control task finished correctly.")
 
 
-async def manage_image_task(image_queue: asyncio.Queue,
-                            name: str, current_res: dict,
-                            output_folder: Path,
+def write_image(image_file, view: memoryview):
+    """Write the whole view to an unbuffered file, a single raw write may only write part of it"""
+    written = 0
+    while written < len(view):
+        written += image_file.write(view[written:])
+
+
+def save_image_thread(buffer_views: List[memoryview], save_queue: queue.Queue, release: Callable[[int], None],
+                      log_queue: queue.SimpleQueue):
+    """Writes the images to disk outside the event loop, so the receiving and decoding tasks are not blocked by the file
+    writes.
+
+    input:
+        * buffer_views: byte views of the buffer pool, written as they are.
+        * save_queue: output and index of the buffer to be saved. The output is either the path of a new file as bytes,
+        or an open file in which the image is appended, in that case a None index closes the file. None stops the thread once
+        the previous images have been saved.
+        * release: called with the index of each buffer once it has been written, or once writing it failed.
+        * log_queue: messages to be printed, the errors of an image are logged and the thread goes on with the next one.
+
+    return:
+        None"""
+    while True:
+        item = save_queue.get()
+        if item is None:
+            return
+        output, idx = item
+        try:
+            if idx is None:
+                output.close()
+            elif isinstance(output, bytes):
+                with open(output, 'wb', buffering=0) as image_file:
+                    write_image(image_file, buffer_views[idx])
+            else:
+                write_image(output, buffer_views[idx])
+        except Exception as e:
+            log_queue.put((1, f"Image not saved: {e}"))
+        finally:
+            # The receiver waits for the buffers, so they are given back even when they could not be written
+            if idx is not None:
+                release(idx)
+
+
+class CaptureSaver:
+    """Sends the images of each capture to the saving thread, either to a new folder with a file per image or appended
+    to a single file of the folder"""
+
+    def __init__(self, output_folder: Path, save_queue: queue.Queue, single_file: bool):
+        self.output_folder = output_folder
+        self.save_queue = save_queue
+        self.single_file = single_file
+        self.capturing_folder = output_folder
+        self.capture_file = None
+        self.save_count = 0
+        self.path_prefix = b""
+
+    def start_capture(self):
+        self.save_count = 0
+        self.capturing_folder = generate_new_capturing_folder(self.output_folder)
+        # The file paths are formatted from it, instead of building a Path for each image
+        self.path_prefix = os.fsencode(os.path.join(self.capturing_folder, ""))
+        if self.single_file:
+            # Fixed size images appended one after the other, opened once for the whole capture
+            self.capture_file = self.capturing_folder.joinpath("capture.raw").open('wb', buffering=0)
+
+    def save(self, idx: int):
+        if self.single_file:
+            self.save_queue.put_nowait((self.capture_file, idx))
+        else:
+            self.save_queue.put_nowait((self.path_prefix + b"%08d.raw" % self.save_count, idx))
+        self.save_count += 1
+
+    def finish_capture(self):
+        if self.single_file:
+            self.save_queue.put_nowait((self.capture_file, None))
+            self.capture_file = None
+
+
+async def manage_image_task(image_queue: AsyncSPSCQueue,
+                            free_queue: AsyncSPSCQueue,
+                            capture_saver: CaptureSaver,
+                            log_queue: queue.SimpleQueue,
+                            name: str, current_res: Resolution,
                             finish: asyncio.Event, start: asyncio.Event,
                             save: bool, no_show: bool):
-    image_display = ImageDisplay(0, current_res["width"], current_res["height"])
+    image_display = ImageDisplay(0, current_res.width, current_res.height)
     while not finish.is_set():
-        while not start.is_set() and not finish.is_set():
-            await asyncio.sleep(0.2)
+        await wait_any_event(start, finish)
         if finish.is_set():
             break
         elif start.is_set():
@@ -279,38 +564,32 @@ async def manage_image_task(image_queue: asyncio.Queue,
                 image_display.setup_window(name)
 
             if save:
-                save_count = 0
-                capturing_folder = generate_new_capturing_folder(output_folder)
-
-            while start.is_set() or not image_queue.empty():
-                if not image_queue.empty():
-                    image = await image_queue.get()
-                    if not no_show:
-                        image_display.show_frame("Arducam", image)
-
-                    if save:
-                        filename = f"{save_count:08d}.raw"
-                        file_path = capturing_folder.joinpath(filename)
-                        image.tofile(file_path)
-                        save_count += 1
-                await asyncio.sleep(0.015)
-
-            print_terminal(0, "All images has been processed.")
+                capture_saver.start_capture()
+
+            while True:
+                item = await image_queue.get()
+                if item is None:
+                    # The capture has stopped
+                    break
+                idx, image = item
+                if not no_show:
+                    image_display.show_frame(name, image)
+
+                if save:
+                    capture_saver.save(idx)
+                else:
+                    free_queue.put_nowait(idx)
+
+            if save:
+                capture_saver.finish_capture()
+            log_queue.put((0, "All images has been processed."))
             if not no_show:
-                cv.destroyAllWindows()
+                image_display.close_window(name)
 
 
 async def configure_camera(reader, writer, resolution: str, configuration_complete: asyncio.Event):
     print_terminal(0, "Configuration client connected.")
-    conf_message = ""
-    if resolution == "LOW":
-        conf_message = "--mode 1332:990:10:U --resolution LOW"
-    elif resolution == "MEDIUM":
-        conf_message = "--mode 2028:1520:12:U --resolution MEDIUM"
-    elif resolution == "HIGH":
-        conf_message = "--mode 4056:3040:12:U --resolution HIGH"
-
-    writer.write(conf_message.encode('utf-8'))
+    writer.write(CONF_MESSAGES.get(resolution, b""))
     await writer.drain()
 
     writer.close()
@@ -330,6 +609,10 @@ async def configure_camera_server(ip: str, port: int, resolution: str, configura
         print_terminal(0, "Camera configured.")
 
 
+def buffer_pool_size(current_res: Resolution) -> int:
+    return max(MIN_BUFFER_POOL_SIZE, min(BUFFER_POOL_SIZE, BUFFER_POOL_BYTES // current_res.image_bytes))
+
+
 async def main():
     user_action_map = [
         UserAction(
@@ -356,8 +639,12 @@ async def main():
         ),
     ]
 
-    data_queue = asyncio.Queue()
-    image_queue = asyncio.Queue()
+    # Each one has a single consumer task. They carry indexes of the buffer pool
+    data_queue = AsyncSPSCQueue()
+    image_queue = AsyncSPSCQueue()
+    save_queue = queue.Queue()
+    # Messages printed while capturing, written to the terminal from another thread
+    log_queue = queue.SimpleQueue()
     msg_queue = asyncio.Queue()
     process_msg_queue = asyncio.Queue()
     client_event = asyncio.Event()
@@ -372,8 +659,17 @@ async def main():
         print("Input resolution not implemented")
         return
 
-    # Bytes = height*with*bands*2 bytes each pixel
-    image_bytes = current_res["band_width"] * current_res["band_height"] * 4 * 2
+    # The images are received straight into these buffers, which are given back through the free queue once they have
+    # been shown and saved. They are allocated with their image type, so they are aligned for it, and received through
+    # flat byte views
+    buffer_images = [np.empty(current_res.band_shape, dtype=np.uint16) for _ in range(buffer_pool_size(current_res))]
+    buffer_views = [memoryview(image).cast('B') for image in buffer_images]
+    free_queue = AsyncSPSCQueue()
+    for idx in range(len(buffer_images)):
+        free_queue.put_nowait(idx)
+    if not args.no_show:
+        # Loads or compiles the mosaic kernel for the type of the buffers now, instead of delaying the first frame
+        generate_arducam_mosaic(buffer_images[0])
 
     config_complete = asyncio.Event()
     conf_task = asyncio.create_task(configure_camera_server(args.ip, TCP_CONF_PORT, args.resolution, config_complete))
@@ -384,26 +680,51 @@ async def main():
     output_folder = Path(args.output_folder)
     if not output_folder.is_dir():
         output_folder.mkdir()
-    capturing_folder = output_folder
-
+    capture_saver = CaptureSaver(output_folder, save_queue, args.single_file)
+
+    # Without showing them, the images only need to be saved or released, which is done without the image queue
+    image_sink = None
+    if args.no_show:
+        image_sink = capture_saver.save if args.save else free_queue.put_nowait
+
+    loop = asyncio.get_running_loop()
+    image_saver = threading.Thread(
+        target=save_image_thread,
+        args=(buffer_views, save_queue, lambda idx: loop.call_soon_threadsafe(free_queue.put_nowait, idx), log_queue))
+    logger = threading.Thread(target=log_thread, args=(log_queue,))
+    # A thread of its own, so that the receiving thread is never waiting behind other executor jobs and it can be
+    # pinned to a CPU without pinning them
+    receive_executor = None
+    if args.receive_thread:
+        receive_executor = ThreadPoolExecutor(
+            max_workers=1, thread_name_prefix="receive",
+            initializer=None if args.pin_cpus is None else pin_thread,
+            initargs=() if args.pin_cpus is None else (args.pin_cpus[2],))
     try:
+        image_saver.start()
+        logger.start()
+        if args.pin_cpus is not None:
+            pin_thread(args.pin_cpus[0])
+            pin_thread(args.pin_cpus[1], image_saver.native_id)
         tk_terminal = asyncio.create_task(async_terminal(user_action_map, process_msg_queue))
         tk_message = asyncio.create_task(message_server(args.ip, TCP_MSG_PORT, msg_queue, finish_event))
         tk_receive = asyncio.shield(
             asyncio.create_task(
-                receive_task(args.ip, TCP_PORT, image_bytes, data_queue, client_event, start_event, finish_event)))
+                receive_task(
+                    args.ip, TCP_PORT, buffer_views, free_queue, data_queue, log_queue,
+                    client_event, finish_event, receive_executor)))
         tk_decode = asyncio.shield(
             asyncio.create_task(
                 decode_task(
-                    current_res, image_bytes, data_queue, image_queue, client_event, start_event, finish_event)))
+                    buffer_images, data_queue, image_queue, log_queue, client_event, start_event, finish_event,
+                    image_sink)))
         tk_control = asyncio.create_task(
             control_task(
                 msg_queue, process_msg_queue, client_event, start_event, finish_event)
         )
         tk_image = asyncio.create_task(
             manage_image_task(
-                image_queue, "Arducam", current_res,
-                output_folder,
+                image_queue, free_queue, capture_saver, log_queue, "Arducam", current_res,
                 finish_event, start_event,
                 args.save, args.no_show))
         await tk_control
@@ -418,9 +739,25 @@ async def main():
         print(e)
         return 1
     finally:
+        # Wait until the pending images have been written
+        save_queue.put(None)
+        if receive_executor is not None:
+            receive_executor.shutdown(wait=False)
+        if image_saver.is_alive():
+            await loop.run_in_executor(None, image_saver.join)
+        log_queue.put(None)
+        if logger.is_alive():
+            await loop.run_in_executor(None, logger.join)
         print("Code finished")
         return 0
 
 
 if __name__ == '__main__':
-    asyncio.run(main())
+    try:
+        # libuv event loop, faster than the default selector one. The default loop is used when it is not installed
+        import uvloop
+        loop_factory = uvloop.new_event_loop
+    except ImportError:
+        loop_factory = None
+    with asyncio.Runner(loop_factory=loop_factory) as runner:
+        runner.run(main())
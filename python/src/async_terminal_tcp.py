@@ -1,4 +1,5 @@
 import sys
+import queue
 from typing import List
 import asyncio
 
@@ -7,17 +8,18 @@ TERMINAL_TIMEOUT = 3
 
 class Message:
 
-    def __init__(self, _need_value: bool, _key: str, _value: int = -1):
+    def __init__(self, _need_value: bool, _key: str, _value: int = -1, _key_b: bytes = None):
         self.need_value = _need_value
         self.key = _key
+        # The key is encoded once, user actions hand over the bytes they already hold
+        self.key_b = _key.encode('utf-8') if _key_b is None else _key_b
         self.value = _value
 
     def encode(self, encode_type: str):
+        key_b = self.key_b if encode_type == 'utf-8' else self.key.encode(encode_type)
         if self.need_value:
-            message = f"{self.key} = {self.value}"
-        else:
-            message = f"{self.key}"
-        return message.encode(encode_type)
+            return b"%s = %d" % (key_b, self.value)
+        return key_b
 
 
 class UserAction:
@@ -25,6 +27,7 @@ class UserAction:
     def __init__(self, description: str, message: str, require_value: bool, _max: int = -1, _min: int = -1):
         self.description = description
         self.message = message
+        self.message_b = message.encode('utf-8')
         self.require_value = require_value
         self.max = _max
         self.min = _min
@@ -36,7 +39,7 @@ class UserAction:
         return f"MAX: {self.max}, MIN: {self.min}"
 
     def get_message(self, value: int = -1) -> Message:
-        return Message(self.require_value, self.message, value)
+        return Message(self.require_value, self.message, value, self.message_b)
 
 
 def print_terminal(severity: int, s: str):
@@ -47,12 +50,30 @@ def print_terminal(severity: int, s: str):
     print("--> ", end="", flush=True)
 
 
+def log_thread(log_queue: queue.SimpleQueue):
+    """Prints the messages logged while capturing, so the event loop never waits for the terminal.
+
+    input:
+        * log_queue: tuples with the severity and the text of the message. None stops the thread.
+
+    return:
+        None"""
+    while True:
+        log = log_queue.get()
+        if log is None:
+            return
+        print_terminal(*log)
+
+
+def prompt_and_read(string: str) -> str:
+    sys.stdout.write(string)
+    sys.stdout.flush()
+    return sys.stdin.readline()
+
+
 async def ainput(string: str) -> str:
-    await asyncio.get_event_loop().run_in_executor(
-            None, lambda s=string: sys.stdout.write(s))
-    await asyncio.sleep(0.2)
-    return await asyncio.get_event_loop().run_in_executor(
-            None, sys.stdin.readline)
+    # The prompt and the read are done by the same executor call, so there is no need to wait between them
+    return await asyncio.get_running_loop().run_in_executor(None, prompt_and_read, string)
 
 
 async def read_int(string: str) -> int:
@@ -75,10 +96,10 @@ async def async_terminal(user_action_map: List[UserAction], process_msg_queue: a
     return:
         None"""
     stop_asking = False
-    user_action_menu = ""
+    # Built once with its header, so it is printed with a single write each time
+    user_action_menu = "==================\n"
     for idx, action in enumerate(user_action_map):
         user_action_menu += f' {idx + 1}: {action.description}\n'
-    print("==================")
     print(user_action_menu)
     while not stop_asking:
         index = await read_int("--> ")
@@ -98,7 +119,6 @@ async def async_terminal(user_action_map: List[UserAction], process_msg_queue: a
 
         else:
             print_terminal(1, "invalid index, select one of the following:")
-            print("==================")
             print(user_action_menu)
     print_terminal(0, "Message receiving thread finished correctly.")
 
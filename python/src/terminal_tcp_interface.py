@@ -11,17 +11,18 @@ TERMINAL_TIMEOUT = 3
 
 class Message:
 
-    def __init__(self, _need_value: bool, _key: str, _value: int = -1):
+    def __init__(self, _need_value: bool, _key: str, _value: int = -1, _key_b: bytes = None):
         self.need_value = _need_value
         self.key = _key
+        # The key is encoded once, user actions hand over the bytes they already hold
+        self.key_b = _key.encode('utf-8') if _key_b is None else _key_b
         self.value = _value
 
     def encode(self, encode_type: str):
+        key_b = self.key_b if encode_type == 'utf-8' else self.key.encode(encode_type)
         if self.need_value:
-            message = f"{self.key} = {self.value}"
-        else:
-            message = f"{self.key}"
-        return message.encode(encode_type)
+            return b"%s = %d" % (key_b, self.value)
+        return key_b
 
 
 class UserAction:
@@ -29,6 +30,7 @@ class UserAction:
     def __init__(self, description: str, message: str, require_value: bool, _max: int = -1, _min: int = -1):
         self.description = description
         self.message = message
+        self.message_b = message.encode('utf-8')
         self.require_value = require_value
         self.max = _max
         self.min = _min
@@ -40,7 +42,7 @@ class UserAction:
         return f"MAX: {self.max}, MIN: {self.min}"
 
     def get_message(self, value: int = -1) -> Message:
-        return Message(self.require_value, self.message, value)
+        return Message(self.require_value, self.message, value, self.message_b)
 
 
 def print_terminal(severity: int, s: str):
@@ -51,6 +53,21 @@ def print_terminal(severity: int, s: str):
     print("--> ", end="", flush=True)
 
 
+def log_thread(log_queue: queue.SimpleQueue):
+    """Prints the messages logged by the threads that handle the images, so they never wait for the terminal.
+
+    input:
+        * log_queue: tuples with the severity and the text of the message. None stops the thread.
+
+    return:
+        None"""
+    while True:
+        log = log_queue.get()
+        if log is None:
+            return
+        print_terminal(*log)
+
+
 def terminal_input(user_action_map: List[UserAction], process_msg_queue: queue.Queue):
     """Waits until an action is asked via terminal to the script. Check if the action is valid and put it in the process
     action queue to be processed and sent to the client.
@@ -63,10 +80,10 @@ def terminal_input(user_action_map: List[UserAction], process_msg_queue: queue.Q
     return:
         None"""
     stop_asking = False
-    user_action_menu = ""
+    # Built once with its header, so it is printed with a single write each time
+    user_action_menu = "==================\n"
     for idx, action in enumerate(user_action_map):
         user_action_menu += f' {idx + 1}: {action.description}\n'
-    print("==================")
     print(user_action_menu)
     print("-->", end=" ", flush=True)
     while not stop_asking:
@@ -92,7 +109,6 @@ def terminal_input(user_action_map: List[UserAction], process_msg_queue: queue.Q
 
             else:
                 print_terminal(1, "invalid index, select one of the following:")
-                print("==================")
                 print(user_action_menu)
             print("-->", end=" ", flush=True)
     print_terminal(0, "Message receiving thread finished correctly.")
@@ -1,12 +1,105 @@
+import asyncio
+import collections
+import functools
 import queue
+import socket
+import struct
 import threading
+import time
 import cv2 as cv
 import os
+import numba
+from numba import cuda
 import numpy as np
-import math
+import mmap
 import datetime as dt
 from pathlib import Path
-from typing import Tuple
+from typing import Optional, Tuple
+
+
+class SPSCQueue:
+    """Unbounded queue for a single consumer thread, lighter than queue.Queue because it is a deque signalled by an
+    event instead of a lock and two conditions. Appending to a deque is atomic, so several producers are also safe"""
+
+    def __init__(self):
+        self._items = collections.deque()
+        self._available = threading.Event()
+
+    def put(self, item, timeout: Optional[float] = None):
+        """Add the item. It never waits, timeout is only accepted to be used where a queue.Queue is"""
+        self._items.append(item)
+        self._available.set()
+
+    def get(self, timeout: Optional[float] = None):
+        """Return the oldest item, waiting up to timeout seconds for one. Raise queue.Empty if there is none"""
+        if not self._items:
+            # Cleared before checking again, so an item put in between is not missed
+            self._available.clear()
+            if not self._items:
+                self._available.wait(timeout)
+        try:
+            return self._items.popleft()
+        except IndexError:
+            raise queue.Empty
+
+    def empty(self) -> bool:
+        return not self._items
+
+    def qsize(self) -> int:
+        return len(self._items)
+
+
+class AsyncSPSCQueue:
+    """asyncio version of SPSCQueue for a single consumer task, cheaper than asyncio.Queue because there is no
+    future per waiting getter or putter. It is unbounded, the producers need to be limited by other means"""
+
+    def __init__(self):
+        self._items = collections.deque()
+        self._available = asyncio.Event()
+
+    def put_nowait(self, item):
+        self._items.append(item)
+        self._available.set()
+
+    async def get(self):
+        """Wait for an item and return it. If the wait is cancelled no item is lost"""
+        while not self._items:
+            self._available.clear()
+            await self._available.wait()
+        return self._items.popleft()
+
+    def empty(self) -> bool:
+        return not self._items
+
+
+def set_receive_timeout(sock: socket.socket, seconds: int):
+    """
+    Set SO_RCVTIMEO on a blocking socket, so blocking receives (e.g. with MSG_WAITALL) give up after the timeout
+    without making the socket non-blocking as settimeout does. struct timeval has 32 or 64 bits fields depending on
+    the time_t of the platform, the size is taken from the current value reported by the kernel
+    params:
+        sock        : Socket in blocking mode
+        seconds     : Receive timeout, a receive that times out raises BlockingIOError
+    returns: None
+    """
+    timeval_64 = struct.calcsize("qq")
+    timeval_size = len(sock.getsockopt(socket.SOL_SOCKET, socket.SO_RCVTIMEO, timeval_64))
+    timeval_format = "qq" if timeval_size == timeval_64 else "ll"
+    sock.setsockopt(socket.SOL_SOCKET, socket.SO_RCVTIMEO, struct.pack(timeval_format, seconds, 0))
+
+
+@functools.lru_cache(maxsize=1)
+def get_screen_resolutions() -> Tuple[Tuple[int, int], ...]:
+    """
+    Return the resolution of every screen (only valid for linux). xrandr is only run the first time, the screens are
+    not expected to change while the scripts run
+    returns: Tuple with the resolution of each screen
+    """
+    import subprocess
+    output = subprocess.check_output(['xrandr'], text=True)
+    # The current mode of each screen is the one marked with *, its first field is the resolution (e.g. 1920x1080)
+    screen_resolution_list_str = [line.split()[0] for line in output.splitlines() if '*' in line]
+    return tuple((int(res.split('x')[0]), int(res.split('x')[1])) for res in screen_resolution_list_str)
 
 
 class ComputerScreen:
@@ -22,34 +115,33 @@ class ComputerScreen:
         returns:
             Tuple with height and width in pixel of the selected screen
             """
-        import subprocess
-        output = subprocess.Popen(
-            'xrandr | grep "\*" | cut -d" " -f4', shell=True, stdout=subprocess.PIPE).communicate()[0]
-        screen_resolution_list_str = output.decode('utf-8')[:-1].split('\n')
-        screen_resolution_list = [
-            (int(res.split('x')[0]), int(res.split('x')[1])) for res in screen_resolution_list_str]
-        return screen_resolution_list[screen_id]
+        return get_screen_resolutions()[screen_id]
 
     def get_height_with_aspect_ratio(self, input_width: int, input_height: int) -> Tuple[int, int]:
-        return self.width, math.floor(input_height / input_width * self.width)
+        """Return the (width, height) with the screen width and the aspect ratio of the input"""
+        return self.width, input_height * self.width // input_width
 
     def get_width_with_aspect_ratio(self, input_width: int, input_height: int) -> Tuple[int, int]:
-        return math.floor(input_height / input_width * self.height), self.height
+        """Return the (width, height) with the screen height and the aspect ratio of the input"""
+        return input_width * self.height // input_height, self.height
 
 
 class ImageDisplay:
     def __init__(self, device_id: int, image_width: int = 0, image_height: int = 0, framerate: int = 5):
         screen_size = self.get_screen_size(device_id)
-        self.screen_height = screen_size[0]
-        self.screen_width = screen_size[1]
+        self.screen_width = screen_size[0]
+        self.screen_height = screen_size[1]
 
         self.window_width = 660
         self.window_height = 480
         self.setup_window_size(image_width, image_height)
 
         self.skip_count = 0
-        self.frames_to_skip = np.floor(framerate / 5)
+        self.frames_to_skip = framerate // 5
         self.font = cv.FONT_HERSHEY_SIMPLEX
+        # Mosaic reused by every shown frame, the bands are half the size of the image
+        self.mosaic = np.empty((image_height // 2 * 2, image_width // 2 * 2), dtype=np.uint8)
+        self.window_ready = False
 
     @staticmethod
     def get_screen_size(screen_id: int) -> Tuple[int, int]:
@@ -59,21 +151,17 @@ class ImageDisplay:
         returns:
             Tuple with height and width in pixel of the selected screen
             """
-        import subprocess
-        output = subprocess.Popen(
-            'xrandr | grep "\*" | cut -d" " -f4', shell=True, stdout=subprocess.PIPE).communicate()[0]
-        screen_resolution_list_str = output.decode('utf-8')[:-1].split('\n')
-        screen_resolution_list = [
-            (int(res.split('x')[0]), int(res.split('x')[1])) for res in screen_resolution_list_str]
-        return screen_resolution_list[screen_id]
+        return get_screen_resolutions()[screen_id]
 
     def get_height_with_aspect_ratio(self, input_width: int, input_height: int) -> Tuple[int, int]:
-        return self.screen_width, math.floor(input_height / input_width * self.screen_width)
+        """Return the (width, height) with the screen width and the aspect ratio of the input"""
+        return self.screen_width, input_height * self.screen_width // input_width
 
     def get_width_with_aspect_ratio(self, input_width: int, input_height: int) -> Tuple[int, int]:
-        return math.floor(input_height / input_width * self.screen_height), self.screen_height
+        """Return the (width, height) with the screen height and the aspect ratio of the input"""
+        return input_width * self.screen_height // input_height, self.screen_height
 
-    def setup_window_size(self, image_height: int, image_width: int):
+    def setup_window_size(self, image_width: int, image_height: int):
         window_size = self.get_width_with_aspect_ratio(image_width, image_height)
         self.window_width = int(window_size[0] * 0.95)
         self.window_height = int(window_size[1] * 0.95)
@@ -81,18 +169,33 @@ class ImageDisplay:
     def setup_window(self, name):
         cv.namedWindow(name, cv.WINDOW_NORMAL)
         cv.resizeWindow(name, self.window_width, self.window_height)
+        self.window_ready = True
+
+    def close_window(self, name):
+        cv.destroyWindow(name)
+        self.window_ready = False
 
     def show_frame(self, name: str, frame: np.ndarray):
         if self.skip_count == self.frames_to_skip:
-            mosaic = generate_arducam_mosaic(frame)
-            cv.imshow(name, mosaic)
+            # The window is only created and sized once, not for every frame
+            if not self.window_ready:
+                self.setup_window(name)
+            self.mosaic = generate_arducam_mosaic(frame, self.get_mosaic_buffer(frame))
+            cv.imshow(name, self.mosaic)
             cv.waitKey(1)
             self.skip_count = 0
         else:
             self.skip_count += 1
 
+    def get_mosaic_buffer(self, frame: np.ndarray) -> np.ndarray:
+        """Return the mosaic buffer, allocated again only when the shape of the frames changes"""
+        mosaic_shape = (frame.shape[1] * 2, frame.shape[2] * 2)
+        if self.mosaic.shape != mosaic_shape:
+            self.mosaic = np.empty(mosaic_shape, dtype=np.uint8)
+        return self.mosaic
+
     def study_frame(self, name: str, frame: np.ndarray, index: int) -> int:
-        mosaic = generate_arducam_mosaic(frame)
+        mosaic = generate_arducam_mosaic(frame, self.get_mosaic_buffer(frame))
         text = f"Image: {index:5d}"
         mosaic = cv.cvtColor(mosaic, cv.COLOR_GRAY2RGB)
         cv.putText(mosaic, text, (100, 200), self.font, 4, (0, 255, 0), 2, cv.LINE_AA)
@@ -101,6 +204,10 @@ class ImageDisplay:
         return key
 
 
+# Windows already created by show_image
+_created_windows = set()
+
+
 def show_image(
         name: str,
         image: np.ndarray,
@@ -110,54 +217,301 @@ def show_image(
     """
     Split the images in the 9 bands and show it in the screen
     params:
-        image       : Raw image obtained from the camera
-        ms_sleep    : Milliseconds waited between frames
+        image           : Raw image obtained from the camera
+        ms_sleep        : Milliseconds waited between frames
+        window_size     : Size of the window, only applied when it is created
+        window_position : Position of the window, only applied when it is created
     returns: None
     """
-
-    cv.namedWindow(name, cv.WINDOW_NORMAL)
-    if window_size != (-1, -1):
-        cv.resizeWindow(name, *window_size)
-    if window_position != (-1, -1):
-        cv.moveWindow(name, *window_position)
+    if name not in _created_windows:
+        cv.namedWindow(name, cv.WINDOW_NORMAL)
+        if window_size != (-1, -1):
+            cv.resizeWindow(name, *window_size)
+        if window_position != (-1, -1):
+            cv.moveWindow(name, *window_position)
+        _created_windows.add(name)
     cv.imshow(name, image)
     cv.waitKey(ms_sleep)
 
 
 def read_arducam_image(path: Path, current_res: dict) -> np.ndarray:
-    raw_image = np.fromfile(path, dtype=np.uint16)
+    """
+    Map a raw file in memory and return it as a read-only image, the data is read from the page cache on access
+    instead of being copied to a new array
+    params:
+        path        : Path to the raw file
+        current_res : Resolution of the image
+    returns: Image with shape (4, band_height, band_width). The mapping is released with the array
+    """
+    with open(path, 'rb') as raw_file:
+        raw_map = mmap.mmap(raw_file.fileno(), 0, access=mmap.ACCESS_READ)
+    # The array keeps a reference to the mapping, which stays valid after the file is closed
+    raw_image = np.frombuffer(raw_map, dtype=np.uint16)
     raw_image = raw_image.reshape(4, current_res["band_height"], current_res["band_width"])
     return raw_image
 
 
+def read_raw_into(path: Path, buffer: np.ndarray) -> int:
+    """
+    Read a raw file directly into a preallocated buffer (e.g. a pinned host array) without
+    allocating a new array
+    params:
+        path        : Path to the raw file
+        buffer      : Contiguous array in which the file content is written
+    returns: Number of bytes read
+    """
+    # Unbuffered, so the file is read with a single call straight into the buffer memory
+    with open(path, 'rb', buffering=0) as raw_file:
+        bytes_read = raw_file.readinto(memoryview(buffer).cast('B'))
+    if bytes_read != buffer.nbytes:
+        raise ValueError(f"{path} contains {bytes_read} bytes, {buffer.nbytes} were expected")
+    return bytes_read
+
+
 def generate_new_capturing_folder(output_path: Path) -> Path:
-    capturing_path = output_path.joinpath(dt.datetime.now().strftime('%Y_%m_%d__%H_%M'))
+    # The time is taken once, so every candidate name has the same prefix even if the minute changes while looking
+    folder_name = dt.datetime.now().strftime('%Y_%m_%d__%H_%M')
+    capturing_path = output_path.joinpath(folder_name)
     folder_count = 0
     while capturing_path.is_dir():
-        capturing_path = output_path.joinpath(
-            dt.datetime.now().strftime('%Y_%m_%d__%H_%M') + str(folder_count))
+        capturing_path = output_path.joinpath(folder_name + str(folder_count))
         folder_count += 1
     capturing_path.mkdir()
     return capturing_path
 
 
-def generate_arducam_mosaic(image: np.ndarray) -> np.ndarray:
-    image_scaled = (image.astype(np.float32) / 4095.0) * 255.0
-    image_to_split = image_scaled.astype(np.uint8)
-    band_height = image_to_split.shape[1]
-    band_width = image_to_split.shape[2]
-    mosaic = np.empty((band_height * 2, band_width * 2), dtype=np.uint8)
-    mosaic[0:band_height, 0:band_width] = image_to_split[0, :, :]
-    mosaic[0:band_height, band_width:2 * band_width] = image_to_split[1, :, :]
-    mosaic[band_height:2 * band_height, 0:band_width] = image_to_split[2, :, :]
-    mosaic[band_height:2 * band_height, band_width:2 * band_width] = image_to_split[3, :, :]
+# 12 bits to 8 bits scale of the mosaic, the same truncation as image / 4095 * 255 cast to uint8 without the float
+# operations. The kernels read it as a constant
+_U12_TO_U8 = ((np.arange(4096, dtype=np.uint32) * 255) // 4095).astype(np.uint8)
+# Same scale as a multiplication and a shift, exact for every 12 bits value. Unlike the table reads, it is vectorized
+# by the CPU kernel
+_U12_TO_U8_MUL = 4081
+_U12_TO_U8_SHIFT = 16
 
-    return mosaic
 
+@numba.njit(parallel=True, cache=True, nogil=True)
+def fill_arducam_mosaic(image: np.ndarray, mosaic: np.ndarray):
+    """
+    Reduce the 12 bits bands to 8 bits, and place them in the 2x2 mosaic in a single pass. Only the 12 least
+    significant bits of each pixel are used. The GIL is released while it runs, so the receiving and saving threads
+    are not stopped by the mosaic
+    params:
+        image       : Raw image with shape (4, band_height, band_width)
+        mosaic      : Output array with shape (2 * band_height, 2 * band_width) and uint8 type
+    returns: None
+    """
+    band_height = image.shape[1]
+    band_width = image.shape[2]
+    for row in numba.prange(band_height):
+        for col in range(band_width):
+            # 32 bits products, so the loop is vectorized with as many lanes as possible
+            mosaic[row, col] = (numba.uint32(image[0, row, col] & 0x0FFF) * _U12_TO_U8_MUL) >> _U12_TO_U8_SHIFT
+            mosaic[row, band_width + col] = (
+                numba.uint32(image[1, row, col] & 0x0FFF) * _U12_TO_U8_MUL) >> _U12_TO_U8_SHIFT
+            mosaic[band_height + row, col] = (
+                numba.uint32(image[2, row, col] & 0x0FFF) * _U12_TO_U8_MUL) >> _U12_TO_U8_SHIFT
+            mosaic[band_height + row, band_width + col] = (
+                numba.uint32(image[3, row, col] & 0x0FFF) * _U12_TO_U8_MUL) >> _U12_TO_U8_SHIFT
+
+
+@cuda.jit
+def cuda_fill_arducam_mosaic(image, mosaic):
+    """GPU version of fill_arducam_mosaic, each thread places one pixel of every band"""
+    col, row = cuda.grid(2)
+    band_height = image.shape[1]
+    band_width = image.shape[2]
+    if row < band_height and col < band_width:
+        mosaic[row, col] = _U12_TO_U8[image[0, row, col] & 0x0FFF]
+        mosaic[row, band_width + col] = _U12_TO_U8[image[1, row, col] & 0x0FFF]
+        mosaic[band_height + row, col] = _U12_TO_U8[image[2, row, col] & 0x0FFF]
+        mosaic[band_height + row, band_width + col] = _U12_TO_U8[image[3, row, col] & 0x0FFF]
+
+
+class CudaMosaic:
+    """Generate the display mosaic in the GPU. The image is uploaded from a pinned buffer and the mosaic downloaded to
+    another one, both allocated once for the given image shape"""
+
+    def __init__(self, image_shape: Tuple[int, int, int], threads_per_block: Tuple[int, int] = (32, 8)):
+        band_height, band_width = image_shape[1], image_shape[2]
+        mosaic_shape = (band_height * 2, band_width * 2)
+        self.stream = cuda.stream()
+        self.image_h = cuda.pinned_array(image_shape, dtype=np.uint16)
+        self.image_d = cuda.device_array(image_shape, dtype=np.uint16)
+        self.mosaic_h = cuda.pinned_array(mosaic_shape, dtype=np.uint8)
+        self.mosaic_d = cuda.device_array(mosaic_shape, dtype=np.uint8)
+        self.threads_per_block = threads_per_block
+        self.blocks_per_grid = (
+            (band_width + threads_per_block[0] - 1) // threads_per_block[0],
+            (band_height + threads_per_block[1] - 1) // threads_per_block[1])
+
+    def generate(self, image: np.ndarray) -> np.ndarray:
+        """Return the mosaic of the image. The returned array is reused by the next call"""
+        np.copyto(self.image_h, image)
+        self.image_d.copy_to_device(self.image_h, stream=self.stream)
+        cuda_fill_arducam_mosaic[self.blocks_per_grid, self.threads_per_block, self.stream](
+            self.image_d, self.mosaic_d)
+        self.mosaic_d.copy_to_host(self.mosaic_h, stream=self.stream)
+        self.stream.synchronize()
+        return self.mosaic_h
+
+
+def generate_arducam_mosaic(image: np.ndarray, out: Optional[np.ndarray] = None) -> np.ndarray:
+    """
+    Build the 2x2 mosaic of the 4 bands of the image scaled to 8 bits
+    params:
+        image       : Raw image with shape (4, band_height, band_width)
+        out         : Optional preallocated output, reused to avoid an allocation per frame
+    returns: The mosaic, which is out when it is given
+    """
+    if out is None:
+        out = np.empty((image.shape[1] * 2, image.shape[2] * 2), dtype=np.uint8)
+    fill_arducam_mosaic(image, out)
+    return out
+
+
+def put_until_stopped(output_queue: queue.Queue, item, stop_event: threading.Event) -> bool:
+    """
+    Put the item in a queue that may be bounded, waiting for a free slot until the stop event is set
+    returns: False if the thread was stopped before the item could be put
+    """
+    while not stop_event.is_set():
+        try:
+            output_queue.put(item, timeout=0.1)
+            return True
+        except queue.Full:
+            pass
+    return False
+
+
+class MosaicMetrics:
+    """Counters of arducam_mosaic_thread, to see if it keeps up with the images. The latencies are kept for the last
+    LATENCY_SAMPLES mosaics only, so the memory is bounded"""
+    LATENCY_SAMPLES = 1024
+
+    def __init__(self):
+        self.frames_in = 0
+        self.frames_out = 0
+        self.depth_hwm = 0
+        self.latencies_us = collections.deque(maxlen=self.LATENCY_SAMPLES)
+
+    def percentile(self, percent: float) -> float:
+        """Return the given percentile of the recent latencies in microseconds, 0 if there is none. It can be called
+        from another thread while the mosaic thread runs"""
+        # Copied in a single step, numpy iterating the deque would fail if a latency is appended meanwhile
+        latencies_us = list(self.latencies_us)
+        if not latencies_us:
+            return 0.0
+        return float(np.percentile(latencies_us, percent))
+
+    def summary(self) -> str:
+        return (f"in: {self.frames_in}, out: {self.frames_out}, max queue depth: {self.depth_hwm}, "
+                f"latency p50: {self.percentile(50):.0f} us, p99: {self.percentile(99):.0f} us")
+
+
+def arducam_mosaic_thread(
+        input_queue: queue.Queue,
+        output_queue: queue.Queue,
+        stop_event: threading.Event,
+        release_queue: Optional[queue.Queue] = None,
+        latest_only: bool = False,
+        metrics: Optional[MosaicMetrics] = None):
+    """
+    Generate the mosaic of every image of the input queue and put it in the output queue
+    params:
+        input_queue     : Queue with the raw images
+        output_queue    : Queue in which the mosaics are put. It can be bounded (e.g. maxsize=2) so the thread waits
+                          for the consumer instead of queueing mosaics without limit
+        stop_event      : The thread finishes when it is set
+        release_queue   : If given, the mosaics are written in two buffers allocated with the first image and
+                          (index, mosaic) is put in the output queue. The consumer puts the index back in this queue
+                          when it is done with the mosaic, and the buffer is used again for a later image. As only
+                          indexes are passed, an SPSCQueue is enough for it and for the input and output queues
+        latest_only     : When several images are waiting, only the newest one is converted and the rest are dropped,
+                          for a display that prefers latency to showing every frame
+        metrics         : If given, it is updated with the images received and sent, the maximum depth of the input
+                          queue and the time from taking each image to putting its mosaic
+    returns: None
+    """
+    mosaic_buffers = []
+    while not stop_event.is_set():
+        # Blocks until an image arrives, the timeout only bounds how long the stop event takes to be seen
+        try:
+            image = input_queue.get(timeout=0.1)
+        except queue.Empty:
+            continue
+        start = time.perf_counter_ns()
+        if metrics is not None:
+            metrics.frames_in += 1
+            metrics.depth_hwm = max(metrics.depth_hwm, input_queue.qsize() + 1)
+        while latest_only:
+            try:
+                image = input_queue.get(timeout=0)
+            except queue.Empty:
+                break
+            if metrics is not None:
+                metrics.frames_in += 1
+        if release_queue is None:
+            item = generate_arducam_mosaic(image)
+        else:
+            if not mosaic_buffers:
+                mosaic_shape = (image.shape[1] * 2, image.shape[2] * 2)
+                mosaic_buffers = [np.empty(mosaic_shape, dtype=np.uint8) for _ in range(2)]
+                for idx in range(len(mosaic_buffers)):
+                    release_queue.put(idx)
+            idx = None
+            while idx is None and not stop_event.is_set():
+                try:
+                    idx = release_queue.get(timeout=0.1)
+                except queue.Empty:
+                    pass
+            if idx is None:
+                break
+            item = (idx, generate_arducam_mosaic(image, mosaic_buffers[idx]))
+        if put_until_stopped(output_queue, item, stop_event) and metrics is not None:
+            metrics.frames_out += 1
+            metrics.latencies_us.append((time.perf_counter_ns() - start) / 1000)
+
+
+def display_thread(
+        name: str,
+        input_queue: queue.Queue,
+        stop_event: threading.Event,
+        release_queue: Optional[queue.Queue] = None,
+        window_size: Tuple[int, int] = (-1, -1),
+        window_position: Tuple[int, int] = (-1, -1)):
+    """
+    Show the mosaics of arducam_mosaic_thread in a window, so the capture and the mosaic are not slowed down by the
+    GUI. Only the newest mosaic of the queue is shown, the older ones are dropped. HighGUI is not thread safe, so no
+    other thread may use OpenCV windows while it runs
+    params:
+        name            : Name of the window
+        input_queue     : Output queue of arducam_mosaic_thread
+        stop_event      : The thread finishes when it is set
+        release_queue   : The release queue given to arducam_mosaic_thread, the buffer indexes are put back in it once
+                          the mosaic has been shown or dropped
+        window_size     : Size of the window
+        window_position : Position of the window
+    returns: None
+    """
+    def release(item):
+        if release_queue is not None:
+            release_queue.put(item[0])
 
-def arducam_mosaic_thread(input_queue: queue.Queue, output_queue: queue.Queue, stop_event: threading.Event):
     while not stop_event.is_set():
-        if not input_queue.empty():
-            image = input_queue.get()
-            mosaic = generate_arducam_mosaic(image)
-            output_queue.put(mosaic)
+        try:
+            item = input_queue.get(timeout=0.1)
+        except queue.Empty:
+            continue
+        while True:
+            try:
+                newer_item = input_queue.get(timeout=0)
+            except queue.Empty:
+                break
+            release(item)
+            item = newer_item
+        mosaic = item if release_queue is None else item[1]
+        show_image(name, mosaic, 1, window_size, window_position)
+        release(item)
+    if name in _created_windows:
+        cv.destroyWindow(name)
+        _created_windows.discard(name)